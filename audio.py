@@ -4,8 +4,16 @@
 
 import random
 import os
+import json
+import math
+import functools
+import subprocess
+import numpy as np
 from pytube import YouTube
 from moviepy.editor import *
+from moviepy.audio.AudioClip import AudioArrayClip
+from media import get_media_index
+from render import PLAIN_AUDIO
 
 # author information
 __author__ = "Caleb Smith"
@@ -15,6 +23,21 @@ __maintainer__ = "Caleb Smith"
 __email__ = "me@calebmsmith.com"
 __status__ = "Development"
 
+# directory of decoded tracks and their format
+AUDIO_POOL = os.getenv('AUDIO_POOL', 'audio_pool')
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+
+# loudness every track is normalized to, as RMS in dBFS
+TARGET_LOUDNESS = -16.0
+
+# level below which the start and end of a track count as silent, in dBFS
+SILENCE_THRESHOLD = -45.0
+
+# tempo range searched by the beat analysis
+MIN_BPM = 60
+MAX_BPM = 180
+
 
 def download_audio(url: str):
     """
@@ -39,6 +62,13 @@ def download_audio(url: str):
         new_file = base + '.mp3'
         os.rename(out_file, new_file)
 
+        # drop the track if the archive already holds the same file under another name
+        duplicate = get_media_index('audio_archive', ('.mp3',)).find_duplicate(new_file)
+        if duplicate is not None:
+            print(f"Skipping duplicate of {duplicate}")
+            os.remove(new_file)
+            return False
+
         return True
     except Exception as e:
         print(f"Error downloading audio: {str(e)}")
@@ -67,6 +97,320 @@ def populate_audio():
         download_audio(download_url)
 
 
+class AudioPool:
+    def __init__(self, directory: str = AUDIO_POOL, normalize: bool = True):
+        """
+        Constructor for the AudioPool class.
+
+        :param directory: directory in which decoded tracks are stored
+        :param normalize: apply each track's loudness gain to the served windows
+        :return: None
+        """
+        self._directory = directory
+        self._normalize = normalize
+        self._tracks = {}
+        self._beats = {}
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Method to decode every archive track which is new or has changed since it was last decoded
+
+        :return: None
+        """
+        os.makedirs(self._directory, exist_ok=True)
+
+        self._tracks = {}
+        self._beats = {}
+
+        for entry in get_media_index('audio_archive', ('.mp3',)).get_entries():
+            name = os.path.splitext(os.path.basename(entry['path']))[0]
+            samples_path = os.path.join(self._directory, name + '.f32')
+            info_path = os.path.join(self._directory, name + '.json')
+
+            info = None
+            if os.path.exists(info_path) and os.path.exists(samples_path):
+                with open(info_path, 'r') as infile:
+                    info = json.load(infile)
+
+            if info is None or info['mtime'] != entry['mtime']:
+                try:
+                    info = self.decode(entry['path'], samples_path, info_path, entry['mtime'])
+                except IOError as e:
+                    print(f"Error decoding audio: {str(e)}")
+                    continue
+
+            if 'beats' not in info:
+                # decoded before beats were analyzed, the samples can be reused
+                info.update(analyze_beats(read_samples(samples_path)))
+                write_info(info_path, info)
+
+            self._tracks[entry['path']] = (samples_path, info['gain'])
+            self._beats[entry['path']] = (np.array(info['beats'], dtype='float64'), info['intro'], info['outro'])
+
+    @staticmethod
+    def decode(source: str, samples_path: str, info_path: str, mtime: float):
+        """
+        Method to decode a track to raw float samples and measure its loudness and beats
+
+        :param source: path of the track
+        :param samples_path: path of the raw samples file
+        :param info_path: path of the track information file
+        :param mtime: modification time of the track
+        :return: track information
+        """
+        temp_path = samples_path + '.' + str(os.getpid()) + '.tmp'
+
+        command = ['ffmpeg',
+                   '-y',
+                   '-v', 'error',
+                   '-i', source,
+                   '-vn',
+                   '-f', 'f32le',
+                   '-ac', str(AUDIO_CHANNELS),
+                   '-ar', str(AUDIO_FPS),
+                   temp_path]
+
+        result = subprocess.run(command, capture_output=True, text=True)
+
+        if result.returncode != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise IOError(f'ffmpeg failed to decode "{source}": {result.stderr.strip()}')
+
+        samples = read_samples(temp_path)
+        info = {'mtime': mtime, 'gain': loudness_gain(samples)}
+        info.update(analyze_beats(samples))
+
+        os.replace(temp_path, samples_path)
+        write_info(info_path, info)
+
+        return info
+
+    def get_tracks(self):
+        """
+        Method to get the decoded tracks
+
+        :return: dictionary of track paths to (samples path, gain)
+        """
+        return self._tracks
+
+    def choose_start(self, entry: dict, duration: float):
+        """
+        Method to pick the start of a window on a beat, after the silent intro and before the silent end of a track
+
+        :param entry: media index entry of the track
+        :param duration: duration of the window
+        :return: start second, or None if the track is not decoded or too short once silence is skipped
+        """
+        if entry['path'] not in self._beats:
+            return None
+
+        beats, intro, outro = self._beats[entry['path']]
+        latest = min(outro, entry['duration']) - duration
+
+        if latest < intro:
+            return None
+
+        candidates = beats[(beats >= intro) & (beats <= latest)]
+
+        if len(candidates) == 0:
+            # no beats were found, any start after the intro will do
+            return random.uniform(intro, latest)
+
+        return float(random.choice(candidates))
+
+    def window(self, duration: float):
+        """
+        Method to get a random window of a random track which is long enough, starting on a beat
+
+        :param duration: duration of the window
+        :return: tuple of (array of samples, a view into the memory-mapped track unless normalized, and the beats
+                 inside the window in seconds from its start)
+        """
+        entry, start = get_media_index('audio_archive', ('.mp3',)).pick_segment(duration, choose=self.choose_start)
+
+        samples_path, gain = self._tracks[entry['path']]
+        samples = read_samples(samples_path)
+
+        # the index duration may differ slightly from the decoded length
+        length = int(duration * AUDIO_FPS)
+        first = min(int(start * AUDIO_FPS), max(0, len(samples) - length))
+        window = samples[first:first + length]
+
+        if self._normalize and gain != 1.0:
+            window = window * np.float32(gain)
+
+        beats = self._beats[entry['path']][0] - first / AUDIO_FPS
+        beats = beats[(beats >= 0) & (beats < duration)]
+
+        return window, beats.tolist()
+
+    def random_window(self, duration: float):
+        """
+        Method to get a random window as an audio clip along with its beats
+
+        :param duration: duration of the clip
+        :return: tuple of (audio clip backed by the samples, beats in seconds from the start of the clip)
+        """
+        samples, beats = self.window(duration)
+        clip = AudioArrayClip(samples, fps=AUDIO_FPS).set_duration(duration)
+
+        # the encoders pipe the samples straight from the memory-mapped track instead of resampling the clip
+        PLAIN_AUDIO[clip] = samples
+
+        return clip, beats
+
+    def random_clip(self, duration: float):
+        """
+        Method to get a random window as an audio clip
+
+        :param duration: duration of the clip
+        :return: audio clip backed by the samples
+        """
+        return self.random_window(duration)[0]
+
+
+def read_samples(path: str):
+    """
+    Memory-maps a raw samples file.
+
+    :param path: Path of the raw samples file
+    :return: Read-only array of shape (samples, channels)
+    """
+
+    return np.memmap(path, dtype='float32', mode='r').reshape(-1, AUDIO_CHANNELS)
+
+
+def loudness_gain(samples: np.ndarray, target: float = TARGET_LOUDNESS, chunk: int = AUDIO_FPS * 10):
+    """
+    Computes the gain which brings a track to the target loudness without clipping.
+
+    :param samples: Array of samples
+    :param target: Target RMS level in dBFS
+    :param chunk: Number of samples processed at a time
+    :return: Linear gain
+    """
+
+    total = 0.0
+    count = 0
+    peak = 0.0
+
+    # process in chunks so the whole track is never loaded at once
+    for i in range(0, len(samples), chunk):
+        block = np.asarray(samples[i:i + chunk], dtype=np.float64)
+        total += float(np.square(block).sum())
+        count += block.size
+        peak = max(peak, float(np.abs(block).max()))
+
+    if count == 0 or total == 0:
+        return 1.0
+
+    rms = math.sqrt(total / count)
+    gain = 10 ** ((target - 20 * math.log10(rms)) / 20)
+
+    return min(gain, 1.0 / peak)
+
+
+def analyze_beats(samples: np.ndarray, size: int = 2048, hop: int = 512, chunk: int = 1024):
+    """
+    Estimates the tempo, beats and silent start and end of a track from its spectral flux.
+
+    :param samples: Array of samples of shape (samples, channels)
+    :param size: Length of the analysis frames
+    :param hop: Distance between analysis frames
+    :param chunk: Number of frames transformed at a time
+    :return: Dictionary of 'tempo' (BPM or None), 'beats', 'intro' and 'outro' (seconds)
+    """
+
+    mono = samples.mean(axis=1, dtype='float32')
+    count = (len(mono) - size) // hop + 1
+    rate = AUDIO_FPS / hop
+
+    if count < 2:
+        return {'tempo': None, 'beats': [], 'intro': 0.0, 'outro': len(mono) / AUDIO_FPS}
+
+    frames = np.lib.stride_tricks.sliding_window_view(mono, size)[::hop][:count]
+    hann = np.hanning(size).astype('float32')
+
+    flux = np.zeros(count, dtype='float32')
+    level = np.zeros(count, dtype='float32')
+    previous = None
+
+    # process in chunks so the spectrogram of the whole track is never held at once
+    for first in range(0, count, chunk):
+        block = frames[first:first + chunk]
+        spectrum = np.log1p(np.abs(np.fft.rfft(block * hann, axis=1)))
+
+        reference = np.vstack([spectrum[:1] if previous is None else previous, spectrum[:-1]])
+        flux[first:first + len(block)] = np.maximum(spectrum - reference, 0).sum(axis=1)
+        level[first:first + len(block)] = np.sqrt(np.square(block).mean(axis=1))
+
+        previous = spectrum[-1:]
+
+    # skip silence at the start and end
+    loud = np.flatnonzero(level > 10 ** (SILENCE_THRESHOLD / 20))
+    intro = loud[0] * hop / AUDIO_FPS if len(loud) else 0.0
+    outro = (loud[-1] * hop + size) / AUDIO_FPS if len(loud) else len(mono) / AUDIO_FPS
+
+    # onsets stand out from the local average of the flux
+    envelope = np.maximum(flux - np.convolve(flux, np.ones(16) / 16, mode='same'), 0)
+
+    # the tempo is the lag at which the envelope best correlates with itself, preferring lags near 120 BPM
+    spectrum = np.fft.rfft(envelope, 2 * count)
+    correlation = np.fft.irfft(np.abs(spectrum) ** 2)[:count]
+    lags = np.arange(int(rate * 60 / MAX_BPM), min(int(rate * 60 / MIN_BPM) + 1, count))
+
+    if len(lags) == 0 or not envelope.any():
+        return {'tempo': None, 'beats': [], 'intro': float(intro), 'outro': float(outro)}
+
+    weights = np.exp(-0.5 * np.log2(lags / (rate * 60 / 120)) ** 2)
+    period = int(lags[np.argmax(correlation[lags] * weights)])
+
+    # the phase is the offset whose beat grid collects the most onset strength
+    padded = np.pad(envelope, (0, -count % period))
+    phase = int(np.argmax(padded.reshape(-1, period).sum(axis=0)))
+    grid = np.arange(phase, count, period)
+
+    # move every beat of the grid to the strongest onset nearby
+    radius = max(1, period // 8)
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(envelope, (radius, radius)), 2 * radius + 1)
+    beats = grid + np.argmax(windows[grid], axis=1) - radius
+
+    return {'tempo': round(60 * rate / period, 2),
+            'beats': ((beats * hop + size / 2) / AUDIO_FPS).round(3).tolist(),
+            'intro': float(intro),
+            'outro': float(outro)}
+
+
+def write_info(path: str, info: dict):
+    """
+    Writes the information file of a decoded track atomically.
+
+    :param path: Path of the information file
+    :param info: Track information
+    :return: None
+    """
+
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(info, outfile)
+
+    os.replace(path + '.tmp', path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_audio_pool():
+    """
+    Gets the shared audio pool, decoding new tracks on first use.
+
+    :return: AudioPool
+    """
+
+    return AudioPool()
+
+
 def random_audio_clip(duration: float):
     """
     Selects a random X-second audio clip from the 'Audio' folder.
@@ -75,22 +419,16 @@ def random_audio_clip(duration: float):
     :return: X-second audio clip
     """
 
-    # fet a list of audio files in the 'audio' directory
-    audio_files = [file for file in os.listdir('audio_archive') if file.endswith('.mp3')]
-
-    if not audio_files:
-        raise FileNotFoundError("No audio files found in the 'Audio' directory.")
-
-    # randomly select an audio file
-    selected_audio_file = random.choice(audio_files)
+    # serve a window of an already decoded track
+    return get_audio_pool().random_clip(duration)
 
-    # open the selected audio file
-    clip = AudioFileClip(os.path.join('audio_archive', selected_audio_file))
 
-    # fet a random X-second segment based on clip duration
-    end_point = random.uniform(duration, clip.duration)
+def random_audio_window(duration: float):
+    """
+    Selects a random audio clip starting on a beat, along with the beats it contains.
 
-    # fet a subclip with the desired duration
-    clip = clip.subclip(end_point - duration, end_point)
+    :param duration: Desired duration of the audio clip
+    :return: Tuple of (audio clip, beats in seconds from the start of the clip)
+    """
 
-    return clip
+    return get_audio_pool().random_window(duration)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+batch.py
+
+Renders many shorts in parallel using a pool of worker processes.
+"""
+
+import random
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from generator import *
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# default worker settings, overridable through the environment
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', max(1, (os.cpu_count() or 1) // 2)))
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', 2))
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', 'scratch')
+
+
+def init_worker():
+    """
+    Prepares a freshly started worker process.
+
+    :return: None
+    """
+
+    # forked workers inherit the parent's random state, reseed so they pick different media
+    random.seed()
+
+
+def render_job(duration: float, data: dict, profile, threads: int, scratch_root: str):
+    """
+    Renders a single short inside its own scratch directory.
+
+    :param duration: duration of the video
+    :param data: data to be displayed
+    :param profile: RenderProfile or name of a built-in profile
+    :param threads: number of ffmpeg encoder threads
+    :param scratch_root: directory in which the job's scratch directory is created
+    :return: path of the rendered video
+    """
+
+    os.makedirs(scratch_root, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='job-', dir=scratch_root)
+
+    try:
+        return generate_fact_video(duration, data, profile=profile, threads=threads, scratch=scratch)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def render_batch(jobs: list, workers: int = BATCH_WORKERS, threads: int = FFMPEG_THREADS, retries: int = 1,
+                 scratch_root: str = SCRATCH_DIR, profile='publish'):
+    """
+    Renders a batch of shorts in a process pool.
+
+    :param jobs: list of (duration, data) tuples
+    :param workers: number of worker processes
+    :param threads: number of ffmpeg encoder threads per worker
+    :param retries: number of times a failed job is retried
+    :param scratch_root: directory in which per-job scratch directories are created
+    :param profile: RenderProfile or name of a built-in profile
+    :return: list in the same order as the jobs, holding the output path or the exception of the last attempt
+    """
+
+    results = [None] * len(jobs)
+    attempts = [0] * len(jobs)
+
+    def submit(i: int):
+        duration, data = jobs[i]
+        return executor.submit(render_job, duration, data, profile, threads, scratch_root)
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+
+    try:
+        # submit every job up front
+        pending = {submit(i): i for i in range(len(jobs))}
+
+        while pending:
+            retry = []
+            broken = False
+
+            for future, i in pending.items():
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    # a worker process which died fails every unfinished job, each is retried like any other failure
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    attempts[i] += 1
+
+                    if attempts[i] <= retries:
+                        print(f"Job {i} failed, retrying: {str(e)}")
+                        retry.append(i)
+                    else:
+                        print(f"Job {i} failed: {str(e)}")
+                        results[i] = e
+
+            # a broken pool accepts no new jobs, replace it before resubmitting
+            if broken and retry:
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+
+            pending = {submit(i): i for i in retry}
+    finally:
+        executor.shutdown()
+
+    return results
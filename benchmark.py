@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py
+
+Benchmarks for the performance-sensitive parts of PyShort.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import re
+import argparse
+import tempfile
+import subprocess
+from pool import VideoPool
+from profiling import Recorder, add_hook, remove_hook, peak_rss
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# minimum average PSNR in dB between the ffmpeg and MoviePy render backends
+PARITY_PSNR = 35.0
+
+# rounded backgrounds compared against the original temp.png implementation, as (size, radius, opacity, color)
+BACKGROUND_CASES = [
+    ((300, 120), 30, 1.0, (0, 0, 0)),
+    ((961, 233), 30, 0.6, (255, 255, 255)),
+    ((500, 80), 40, 0.35, (12, 200, 97)),
+    ((64, 64), 32, 0.8, (250, 10, 128)),
+    ((1080, 410), 1, 1.0, (90, 90, 90))
+]
+
+
+def benchmark_video_pool(sizes=(1000, 10000, 100000, 200000), lookups: int = 10000):
+    """
+    Measures the lookup cost of the video pool as it grows.
+
+    :param sizes: Pool sizes to measure
+    :param lookups: Number of lookups per size, half of them hits
+    :return: Dictionary of pool size to average lookup time in nanoseconds
+    """
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        pool = VideoPool(os.path.join(directory, 'pool.db'))
+        added = 0
+
+        for size in sizes:
+            # grow the pool to the next size
+            pool.extend(['https://www.pexels.com/video/' + str(i) + '/' for i in range(added, size)])
+            added = size
+
+            urls = ['https://www.pexels.com/video/' + str(random.randrange(size * 2)) + '/' for _ in range(lookups)]
+
+            start = time.perf_counter_ns()
+            for url in urls:
+                _ = url in pool
+            results[size] = (time.perf_counter_ns() - start) / lookups
+
+    return results
+
+
+# synthetic shorts rendered by the benchmark, fixed so reports can be compared between commits
+CASES = {
+    'fact_7s_2_captions': (7, {'topic': 'Benchmark', 'channel': '@benchmark',
+                               'captions': ['The first caption of the benchmark short.',
+                                            'The second and final caption.']}),
+    'fact_10s_3_captions': (10, {'topic': 'Benchmark', 'channel': '@benchmark',
+                                 'captions': ['A caption which is long enough to wrap over several lines of text.',
+                                              'A short caption.',
+                                              'The last caption of the short.']})
+}
+
+
+def synthesize_media(workspace: str, videos: int = 2, tracks: int = 2, duration: int = 20):
+    """
+    Generates color/noise background videos and sine wave music so the benchmark runs offline.
+
+    :param workspace: Directory in which the archives are created
+    :param videos: Number of background videos
+    :param tracks: Number of music tracks
+    :param duration: Duration of every file in seconds
+    :return: None
+    """
+
+    video_dir = os.path.join(workspace, 'video_archive')
+    audio_dir = os.path.join(workspace, 'audio_archive')
+    os.makedirs(video_dir, exist_ok=True)
+    os.makedirs(audio_dir, exist_ok=True)
+
+    for i in range(videos):
+        source = f'color=c=0x{40 * (i + 1):02x}6080:s=1080x1920:r=30:d={duration},noise=alls=30:allf=t'
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', source, '-c:v', 'libx264',
+                        '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                        os.path.join(video_dir, f'synthetic_{i}.mp4')], check=True)
+
+    for i in range(tracks):
+        source = f'sine=frequency={220 * (i + 1)}:sample_rate=44100:duration={duration}'
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', source, '-ac', '2',
+                        '-c:a', 'libmp3lame', os.path.join(audio_dir, f'synthetic_{i}.mp3')], check=True)
+
+
+def benchmark_shorts(profile: str = 'publish', cases: dict = None):
+    """
+    Renders the benchmark shorts in a scratch workspace and measures every stage.
+
+    :param profile: Render profile used for the shorts
+    :param cases: Dictionary of case name to (duration, data), defaults to CASES
+    :return: Dictionary of case name to measurements
+    """
+
+    cases = CASES if cases is None else cases
+    results = {}
+
+    recorder = Recorder()
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        synthesize_media(workspace)
+
+        # the archives and caches are resolved relative to the working directory
+        os.chdir(workspace)
+        os.environ.setdefault('MAX_DURATION', '20')
+
+        from generator import generate_fact_video
+
+        add_hook(recorder)
+
+        try:
+            for name, (duration, data) in cases.items():
+                random.seed(0)
+                recorder.reset()
+
+                wall = time.perf_counter()
+                cpu = time.process_time()
+
+                generate_fact_video(duration, data, profile=profile)
+
+                own, children = peak_rss()
+
+                results[name] = {
+                    'wall': time.perf_counter() - wall,
+                    'cpu': time.process_time() - cpu,
+                    'peak_rss_kb': own,
+                    'children_peak_rss_kb': children,
+                    'stages': recorder.get_stages()
+                }
+        finally:
+            remove_hook(recorder)
+            os.chdir(cwd)
+
+    return results
+
+
+def legacy_rounded_background(size: tuple, color: tuple, opacity: float, rad: int, directory: str):
+    """
+    Builds a rounded background the way generate_text did before it was built in memory, through temp.png.
+
+    :param size: Size of the rectangle as (width, height)
+    :param color: RGB color of the rectangle
+    :param opacity: Opacity of the rectangle
+    :param rad: Radius of the corners
+    :param directory: Directory for the temporary image
+    :return: Image clip of the rectangle
+    """
+
+    from moviepy.editor import ColorClip, CompositeVideoClip, ImageClip
+    from PIL import Image, ImageDraw
+
+    path = os.path.join(directory, 'temp.png')
+
+    color_clip = ColorClip(size=size, color=color).set_opacity(opacity)
+    CompositeVideoClip([color_clip]).save_frame(path)
+
+    image = Image.open(path)
+
+    # the original round_corners
+    circle = Image.new('L', (rad * 2, rad * 2), 0)
+    draw = ImageDraw.Draw(circle)
+    draw.ellipse((0, 0, rad * 2 - 1, rad * 2 - 1), fill=255)
+
+    alpha = Image.new('L', image.size, 255)
+    w, h = image.size
+
+    alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
+    alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
+    alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
+    alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
+
+    image.putalpha(alpha)
+    image.save(path)
+
+    return ImageClip(path).set_opacity(opacity)
+
+
+def check_backgrounds(cases: list = None):
+    """
+    Checks that the in-memory rounded backgrounds are pixel-identical to the original temp.png path, including the
+    mask MoviePy composites them with.
+
+    :param cases: List of (size, radius, opacity, color), defaults to BACKGROUND_CASES
+    :return: Dictionary of case description to True if both the frame and the mask are identical
+    """
+
+    from moviepy.editor import ImageClip
+    from video import rounded_background
+
+    cases = BACKGROUND_CASES if cases is None else cases
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size, rad, opacity, color in cases:
+            legacy = legacy_rounded_background(size, color, opacity, rad, directory)
+            current = ImageClip(rounded_background(size, color, opacity, rad), transparent=True).set_opacity(opacity)
+
+            same_frame = (legacy.get_frame(0) == current.get_frame(0)).all()
+            same_mask = (legacy.mask.get_frame(0) == current.mask.get_frame(0)).all()
+
+            results[f'{size[0]}x{size[1]} r={rad} opacity={opacity} color={color}'] = bool(same_frame and same_mask)
+
+    return results
+
+
+def measure_psnr(reference: str, distorted: str):
+    """
+    Measures the average PSNR of a video against a reference with ffmpeg.
+
+    :param reference: Path of the reference video
+    :param distorted: Path of the video to be compared
+    :return: Average PSNR in dB, inf for identical videos
+    """
+
+    result = subprocess.run(['ffmpeg', '-v', 'info', '-i', distorted, '-i', reference, '-lavfi', 'psnr', '-f', 'null',
+                             '-'], capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise IOError(f'ffmpeg failed to compare "{distorted}" with "{reference}": {result.stderr.strip()}')
+
+    match = re.search(r'average:(\S+)', result.stderr)
+
+    if match is None:
+        raise ValueError(f'No PSNR reported for "{distorted}"')
+
+    return float(match.group(1))
+
+
+def check_parity(profile: str = 'publish', cases: dict = None, threshold: float = PARITY_PSNR):
+    """
+    Renders every benchmark short with both backends from the same composition and compares the results.
+
+    :param profile: Render profile used for the shorts
+    :param cases: Dictionary of case name to (duration, data), defaults to CASES
+    :param threshold: Minimum average PSNR of the ffmpeg backend against MoviePy, in dB
+    :return: Dictionary of case name to {'psnr': dB, 'passed': bool}
+    """
+
+    cases = CASES if cases is None else cases
+    results = {}
+
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        synthesize_media(workspace)
+
+        os.chdir(workspace)
+        os.environ.setdefault('MAX_DURATION', '20')
+
+        from generator import build_fact_video
+
+        try:
+            for name, (duration, data) in cases.items():
+                random.seed(0)
+
+                scratch = tempfile.mkdtemp(dir=workspace)
+                short = build_fact_video(duration, data, None, scratch)
+
+                reference = short.render(name + '.moviepy', profile=profile, scratch=scratch, backend='moviepy')
+                rendered = short.render(name + '.ffmpeg', profile=profile, scratch=scratch, backend='ffmpeg')
+
+                psnr = measure_psnr(reference, rendered)
+                results[name] = {'psnr': psnr, 'passed': psnr >= threshold}
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def compare_reports(old: dict, new: dict):
+    """
+    Prints the change in wall time of every case and stage between two reports.
+
+    :param old: Earlier report
+    :param new: Later report
+    :return: None
+    """
+
+    for name, case in new.get('shorts', {}).items():
+        before = old.get('shorts', {}).get(name)
+
+        if before is None:
+            continue
+
+        print(f"{name}: {before['wall']:.2f}s -> {case['wall']:.2f}s ({case['wall'] / before['wall']:.2f}x)")
+
+        for stage_name, stats in case['stages'].items():
+            previous = before['stages'].get(stage_name)
+
+            if previous is not None and previous['wall'] > 0:
+                print(f"    {stage_name}: {previous['wall']:.3f}s -> {stats['wall']:.3f}s "
+                      f"({stats['wall'] / previous['wall']:.2f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PyShort rendering.')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    parser.add_argument('--compare', default=None, help='earlier JSON report to compare against')
+    parser.add_argument('--profile', default='publish', help='render profile for the benchmark shorts')
+    parser.add_argument('--pool-only', action='store_true', help='only benchmark the video pool')
+    parser.add_argument('--parity', action='store_true',
+                        help='only check that the ffmpeg backend matches the MoviePy backend')
+    parser.add_argument('--backgrounds', action='store_true',
+                        help='only check that rounded backgrounds match the original temp.png implementation')
+    args = parser.parse_args()
+
+    if args.backgrounds:
+        backgrounds = check_backgrounds()
+        json.dump(backgrounds, sys.stdout, indent=4)
+        print()
+
+        sys.exit(0 if all(backgrounds.values()) else 1)
+
+    if args.parity:
+        parity = check_parity(args.profile)
+        json.dump(parity, sys.stdout, indent=4)
+        print()
+
+        sys.exit(0 if all(case['passed'] for case in parity.values()) else 1)
+
+    report = {'video_pool_lookup_ns': benchmark_video_pool()}
+
+    if not args.pool_only:
+        report['profile'] = args.profile
+        report['shorts'] = benchmark_shorts(args.profile)
+
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as infile:
+            compare_reports(json.load(infile), report)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+""" cache.py """
+
+import time
+import hashlib
+import json
+import numpy as np
+from moviepy.editor import *
+from video import generate_text
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# fields which affect the rasterized overlay (placement and timing do not)
+STYLE_FIELDS = ('text', 'text_type', 'text_color', 'font', 'font_size', 'box_size', 'bg_opacity', 'bg_padding',
+                'bg_color', 'radius', 'stroke_color', 'stroke_width', 'text_backend')
+
+# seconds after which a temporary file is assumed to be left behind by a crashed writer
+STALE_TEMP_AGE = 3600
+
+
+class OverlayCache:
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Constructor for the OverlayCache class.
+
+        :param directory: directory in which rasterized overlays are stored
+        :param max_bytes: maximum total size of the cache on disk
+        :return: None
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(fields: dict):
+        """
+        Method to compute the content hash for a set of Element fields
+
+        :param fields: Element fields
+        :return: hex digest identifying the overlay
+        """
+        style = {name: fields[name] for name in STYLE_FIELDS if name in fields}
+        encoded = json.dumps(style, sort_keys=True, default=str).encode('utf-8')
+
+        return hashlib.sha1(encoded).hexdigest()
+
+    def path(self, key: str):
+        """
+        Method to get the file path of a cache entry
+
+        :param key: cache key
+        :return: path of the entry
+        """
+        return os.path.join(self._directory, key + '.npy')
+
+    def get(self, fields: dict):
+        """
+        Method to look up a rasterized overlay
+
+        :param fields: Element fields
+        :return: RGBA array or None if the overlay is not cached
+        """
+        path = self.path(self.key(fields))
+
+        try:
+            rgba = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self._misses += 1
+            return None
+
+        # touch the entry so it counts as recently used, another process may have evicted it meanwhile
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self._hits += 1
+        return rgba
+
+    def put(self, fields: dict, rgba: np.ndarray):
+        """
+        Method to store a rasterized overlay
+
+        :param fields: Element fields
+        :param rgba: RGBA array of the overlay
+        :return: None
+        """
+        os.makedirs(self._directory, exist_ok=True)
+
+        path = self.path(self.key(fields))
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+
+        # write to a temporary file first so readers never see a partial entry
+        with open(temp_path, 'wb') as outfile:
+            np.save(outfile, rgba)
+
+        os.replace(temp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Method to remove the least recently used entries until the cache fits its size cap, along with temporary
+        files of crashed writers
+
+        :return: None
+        """
+        entries = []
+        now = time.time()
+
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+
+            # other processes sharing the directory may remove files at any time
+            try:
+                if name.endswith('.npy'):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                elif name.endswith('.tmp') and now - os.stat(path).st_mtime > STALE_TEMP_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        total = sum(size for _, size, _ in entries)
+
+        # remove oldest entries first
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except FileNotFoundError:
+                pass
+
+            total -= size
+
+    def render(self, fields: dict):
+        """
+        Method to get an overlay clip, rasterizing it only if it is not cached
+
+        :param fields: Element fields
+        :return: image clip of the overlay (without position or timing)
+        """
+        rgba = self.get(fields)
+
+        if rgba is None:
+            rgba = rasterize(generate_text(**{name: fields[name] for name in STYLE_FIELDS if name in fields}))
+            self.put(fields, rgba)
+
+        return ImageClip(rgba, transparent=True)
+
+    def get_stats(self):
+        """
+        Method to get the hit and miss counts of the cache
+
+        :return: dictionary of hit and miss counts
+        """
+        return {'hits': self._hits, 'misses': self._misses}
+
+    def clear(self):
+        """
+        Method to delete every entry in the cache and reset the counts
+
+        :return: None
+        """
+        if os.path.isdir(self._directory):
+            for name in os.listdir(self._directory):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(self._directory, name))
+
+        self._hits = 0
+        self._misses = 0
+
+
+def rasterize(clip: VideoClip):
+    """
+    Renders the first frame of a clip, including its mask, into an RGBA array.
+
+    :param clip: Clip to be rasterized
+    :return: RGBA array
+    """
+
+    rgb = clip.get_frame(0)
+
+    if clip.mask is not None:
+        alpha = clip.mask.get_frame(0) * 255
+    else:
+        alpha = np.full(rgb.shape[:2], 255)
+
+    return np.dstack([rgb, alpha]).round().astype('uint8')
+
+
+# shared overlay cache used by Element
+OVERLAY_CACHE = OverlayCache(os.getenv('OVERLAY_CACHE', 'overlay_cache'),
+                             int(os.getenv('OVERLAY_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+compositor.py
+
+Blends static overlays onto a background video with NumPy instead of MoviePy's per-layer compositing.
+"""
+
+import bisect
+import numpy as np
+from moviepy.editor import VideoClip
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+
+def resolve_position(position: tuple, size: tuple, frame_size: tuple):
+    """
+    Converts a MoviePy style position into pixel coordinates.
+
+    :param position: Position as (x, y), each a number or 'left'/'center'/'right' and 'top'/'center'/'bottom'
+    :param size: Size of the overlay as (width, height)
+    :param frame_size: Size of the frame as (width, height)
+    :return: Top-left pixel coordinates as (x, y)
+    """
+
+    w, h = size
+    frame_w, frame_h = frame_size
+
+    x, y = position
+
+    if isinstance(x, str):
+        x = {'left': 0, 'center': (frame_w - w) / 2, 'right': frame_w - w}[x]
+
+    if isinstance(y, str):
+        y = {'top': 0, 'center': (frame_h - h) / 2, 'bottom': frame_h - h}[y]
+
+    return int(x), int(y)
+
+
+def group_boxes(boxes: list):
+    """
+    Groups overlapping boxes, so overlays sharing pixels are flattened together and all others stay apart.
+
+    :param boxes: List of boxes as (x0, y0, x1, y1), empty boxes are skipped
+    :return: List of (bounding box, indices of its boxes in ascending order)
+    """
+
+    groups = []
+
+    for i, box in enumerate(boxes):
+        if box[2] <= box[0] or box[3] <= box[1]:
+            continue
+
+        members = [i]
+
+        # merge with every group the box overlaps, the grown box may then overlap further groups
+        merged = True
+        while merged:
+            merged = False
+
+            for group in groups:
+                other, indices = group
+
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]),
+                           max(box[3], other[3]))
+                    members += indices
+                    groups.remove(group)
+                    merged = True
+                    break
+
+        groups.append((box, members))
+
+    return [(box, sorted(members)) for box, members in groups]
+
+
+class Layer:
+    def __init__(self, overlays: list, frame_size: tuple):
+        """
+        Constructor for the Layer class, flattening overlays into premultiplied RGBA tiles.
+
+        Only the bounding box of every overlay is blended, overlays which overlap share a tile.
+
+        :param overlays: list of (RGBA array, (x, y)) tuples, bottom overlay first
+        :param frame_size: size of the frame as (width, height)
+        :return: None
+        """
+        frame_w, frame_h = frame_size
+
+        # clip every overlay to the frame
+        boxes = []
+        for rgba, (x, y) in overlays:
+            h, w = rgba.shape[:2]
+            boxes.append((max(x, 0), max(y, 0), min(x + w, frame_w), min(y + h, frame_h)))
+
+        # list of (x0, y0, x1, y1, color, inverse alpha) per tile
+        self.tiles = []
+
+        for (x0, y0, x1, y1), indices in group_boxes(boxes):
+            color = np.zeros((y1 - y0, x1 - x0, 3), dtype='float32')
+            alpha = np.zeros((y1 - y0, x1 - x0, 1), dtype='float32')
+
+            for i in indices:
+                rgba, (x, y) = overlays[i]
+                bx0, by0, bx1, by1 = boxes[i]
+
+                # part of the overlay inside the frame
+                part = rgba[by0 - y:by1 - y, bx0 - x:bx1 - x].astype('float32')
+                src_alpha = part[:, :, 3:] / 255
+
+                region = (slice(by0 - y0, by1 - y0), slice(bx0 - x0, bx1 - x0))
+
+                # premultiplied "over" operator
+                color[region] = part[:, :, :3] * src_alpha + color[region] * (1 - src_alpha)
+                alpha[region] = src_alpha + alpha[region] * (1 - src_alpha)
+
+            self.tiles.append((x0, y0, x1, y1, color, 1 - alpha))
+
+    def blend(self, frame: np.ndarray):
+        """
+        Method to blend the layer onto a frame
+
+        :param frame: RGB frame, modified in place
+        :return: the frame
+        """
+        for x0, y0, x1, y1, color, inverse_alpha in self.tiles:
+            region = frame[y0:y1, x0:x1]
+            region[:] = color + region * inverse_alpha
+
+        return frame
+
+
+class StaticCompositor:
+    def __init__(self, background: VideoClip, overlays: list):
+        """
+        Constructor for the StaticCompositor class.
+
+        :param background: background video clip
+        :param overlays: list of (RGBA array, position, start, end) tuples, bottom overlay first
+        :return: None
+        """
+        self._background = background
+
+        frame_size = tuple(background.size)
+
+        # every point in time where the set of active overlays changes
+        self._boundaries = sorted({0.0, float(background.duration)} |
+                                  {float(start) for _, _, start, _ in overlays} |
+                                  {float(end) for _, _, _, end in overlays})
+
+        # pre-flatten the overlays active in each interval
+        self._layers = []
+        for i in range(len(self._boundaries) - 1):
+            t = self._boundaries[i]
+            active = [(rgba, resolve_position(position, (rgba.shape[1], rgba.shape[0]), frame_size))
+                      for rgba, position, start, end in overlays if start <= t < end]
+
+            self._layers.append(Layer(active, frame_size) if active else None)
+
+    def make_frame(self, t: float):
+        """
+        Method to produce the composited frame at a given time
+
+        :param t: time in seconds
+        :return: RGB frame
+        """
+        # frames from readers are shared, so blend onto a copy
+        frame = np.array(self._background.get_frame(t))
+
+        i = bisect.bisect_right(self._boundaries, t) - 1
+
+        if 0 <= i < len(self._layers) and self._layers[i] is not None:
+            self._layers[i].blend(frame)
+
+        return frame
+
+    def to_clip(self):
+        """
+        Method to get the composited video as a clip
+
+        :return: video clip
+        """
+        return VideoClip(self.make_frame, duration=self._background.duration)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+filtergraph.py
+
+Render backend which turns a short into a single ffmpeg filtergraph, so decoding, compositing and encoding of every
+frame happen in native code instead of Python.
+"""
+
+import os
+import shutil
+import tempfile
+import contextlib
+import subprocess
+from PIL import Image
+from compositor import resolve_position
+from render import audio_pipe, split_outputs, output_args
+from profiling import stage
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+
+def build_command(background: str, overlays: list, audio_args: list, duration: float, size: tuple, outputs: list,
+                  fps: int):
+    """
+    Builds the ffmpeg command which composites overlay images onto a background video and encodes the outputs.
+
+    :param background: Path of the background video, used from its start
+    :param overlays: List of (image path, (x, y), start, end), bottom overlay first
+    :param audio_args: ffmpeg input arguments of the audio, None for a silent video
+    :param duration: Duration of the video
+    :param size: Size of the frame as (width, height)
+    :param outputs: List of (path, RenderProfile, video filter or None, container or None) per output file
+    :param fps: Frame rate of the composition
+    :return: List of command arguments
+    """
+
+    width, height = size
+
+    command = ['ffmpeg',
+               '-y',
+               '-v', 'error',
+               '-t', str(duration),
+               '-i', background]
+
+    for path, _, _, _ in overlays:
+        command += ['-i', path]
+
+    # fill the frame with the background
+    graph = [f'[0:v]scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height},fps={fps},'
+             f'setsar=1[b0]']
+
+    # stack the overlays, active in the same half-open intervals as StaticCompositor
+    for i, (_, (x, y), start, end) in enumerate(overlays, 1):
+        graph.append(f"[b{i - 1}][{i}:v]overlay=x={x}:y={y}:enable='gte(t,{start})*lt(t,{end})'[b{i}]")
+
+    chains, streams = split_outputs(f'[b{len(overlays)}]', outputs)
+    graph += chains
+
+    audio_streams = [None] * len(outputs)
+
+    if audio_args is not None:
+        command += audio_args
+        audio_streams = [f'[a{i}]' for i in range(len(outputs))]
+
+        trim = f'[{len(overlays) + 1}:a]atrim=0:{duration},asetpts=PTS-STARTPTS'
+
+        if len(outputs) == 1:
+            graph.append(trim + '[a0]')
+        else:
+            graph.append(trim + f',asplit={len(outputs)}' + ''.join(audio_streams))
+
+    return command + ['-filter_complex', ';'.join(graph)] + output_args(outputs, streams, audio_streams)
+
+
+def encode_filtergraph(background: str, overlays: list, audio, duration: float, size: tuple, outputs: list, fps: int,
+                       scratch: str = None):
+    """
+    Renders a short with one ffmpeg process, writing the overlays as PNG images first and piping the audio.
+
+    :param background: Path of the background video, used from its start
+    :param overlays: List of (RGBA array, position, start, end), bottom overlay first
+    :param audio: Audio clip, None for a silent video
+    :param duration: Duration of the video
+    :param size: Size of the frame as (width, height)
+    :param outputs: List of (path, RenderProfile, video filter or None, container or None) per output file
+    :param fps: Frame rate of the composition
+    :param scratch: Directory for the intermediate files
+    :return: None
+    """
+
+    directory = tempfile.mkdtemp(prefix='filtergraph-', dir=scratch)
+
+    try:
+        images = []
+
+        for i, (rgba, position, start, end) in enumerate(overlays):
+            path = os.path.join(directory, f'overlay_{i}.png')
+            Image.fromarray(rgba, 'RGBA').save(path, compress_level=1)
+
+            images.append((path, resolve_position(position, (rgba.shape[1], rgba.shape[0]), size), start, end))
+
+        with contextlib.ExitStack() as stack:
+            audio_args, pass_fds = None, ()
+
+            if audio is not None:
+                audio_args, audio_fd = stack.enter_context(audio_pipe(audio))
+                pass_fds = (audio_fd,)
+
+            command = build_command(background, images, audio_args, duration, size, outputs, fps)
+
+            # stderr goes to a file so a chatty encoder can never block on a full pipe
+            log = stack.enter_context(tempfile.TemporaryFile())
+            info = stack.enter_context(stage('encode'))
+
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log,
+                                    pass_fds=pass_fds)
+
+            info['frames'] = int(round(duration * fps))
+
+            if result.returncode != 0:
+                log.seek(0)
+                filename = ', '.join(path for path, _, _, _ in outputs)
+                raise IOError(f'ffmpeg failed to render "{filename}": {log.read().decode(errors="replace").strip()}')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -6,10 +6,19 @@ generator.py
 Python script which takes input for video, audio, and data and compiles them into videos.
 """
 
-import subprocess
+import json
+import shutil
+import tempfile
+import functools
 from moviepy.editor import *
 from video import *
 from audio import *
+from cache import *
+from compositor import *
+from render import *
+from profiling import *
+from filtergraph import encode_filtergraph
+from timing import caption_slots
 
 __author__ = "Caleb Smith"
 __credits__ = ["Caleb Smith"]
@@ -18,8 +27,41 @@ __maintainer__ = "Caleb Smith"
 __email__ = "me@calebmsmith.com"
 __status__ = "Development"
 
+# layout of the fact videos
+FACT_TEMPLATE = os.getenv('FACT_TEMPLATE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates',
+                                                        'fact.json'))
+
+# caption changes within this many seconds of a beat are moved onto it
+BEAT_SNAP = float(os.getenv('BEAT_SNAP', 0.3))
+
+# render backend: 'moviepy' composites in Python, 'ffmpeg' in a single filtergraph, 'auto' prefers the filtergraph
+RENDER_BACKEND = os.getenv('RENDER_BACKEND', 'auto')
+
 
 class Element:
+    # overlay cache shared between Elements, set to None to always render from scratch
+    cache = OVERLAY_CACHE
+
+    # default fields for an Element
+    field_defaults = {
+        'text': '',
+        'text_color': 'white',
+        'text_type': 'label',
+        'font': 'Lato-Bold',
+        'font_size': 50,
+        'box_size': (None, None),
+        'bg_opacity': 1.0,
+        'bg_padding': (60, 40),
+        'bg_color': (0, 0, 0),
+        'radius': 30,
+        'stroke_color': None,
+        'stroke_width': 0,
+        'position': ('center', 'center'),
+        'start': 0,
+        'duration': 5,
+        'text_backend': TEXT_BACKEND
+    }
+
     def __init__(self, **kwargs):
         """
         Constructor for the Element class.
@@ -28,32 +70,14 @@ class Element:
         :return: None
         """
 
-        # default fields for an Element
-        self.fields = {
-            'text': '',
-            'text_color': 'white',
-            'text_type': 'label',
-            'font': 'Lato-Bold',
-            'font_size': 50,
-            'box_size': (None, None),
-            'bg_opacity': 1.0,
-            'bg_padding': (60, 40),
-            'bg_color': (0, 0, 0),
-            'radius': 30,
-            'stroke_color': None,
-            'stroke_width': 0,
-            'position': ('center', 'center'),
-            'start': 0,
-            'duration': 5
-        }
-
-        # initialize fields based on provided keyword arguments
-        for key, value in kwargs.items():
-            if key in self.fields:
-                self.__setitem__(key, value)
+        self.fields = dict(self.field_defaults)
 
+        # the clip is built lazily the first time it is needed
         self._clip = None
-        self.update_clip()
+        self._dirty = True
+
+        # initialize fields based on provided keyword arguments
+        self.import_values(kwargs)
 
     @classmethod
     def from_dict(cls, import_dict):
@@ -77,6 +101,39 @@ class Element:
         :return: None
         """
 
+        self.check_field(key, value)
+
+        self.fields[key] = value
+        self.invalidate()
+
+    def update(self, **fields):
+        """
+        Method to set several fields at once, validating all of them before any is applied
+
+        :param fields: field values to be set
+        :return: None
+        """
+
+        # validate everything first so a bad key or value leaves the Element untouched
+        for key, value in fields.items():
+            if key not in self.field_defaults:
+                raise KeyError(f'Unknown field: "{key}"')
+
+            self.check_field(key, value)
+
+        self.fields.update(fields)
+        self.invalidate()
+
+    @staticmethod
+    def check_field(key: str, value):
+        """
+        Method to perform type and value checks for a field
+
+        :param key: key of the field
+        :param value: value to be checked
+        :return: None
+        """
+
         # define expected types and value checks for fields
         field_checks = {
             'text': (str, None),
@@ -92,6 +149,7 @@ class Element:
             'bg_opacity': (float, lambda v: 0 <= v <= 1.0),
             'start': (float, lambda v: v >= 0),
             'duration': (float, lambda v: v >= 0),
+            'text_backend': (str, lambda v: v in TEXT_BACKENDS),
         }
 
         expected_type, value_check = field_checks.get(key, (None, None))
@@ -106,9 +164,6 @@ class Element:
             if value_check is not None and not value_check(value):
                 raise ValueError(f'Invalid value for field: "{key}"')
 
-        self.fields[key] = value
-        self.update_clip()
-
     def __getitem__(self, item: str):
         """
         Method to get a field's value
@@ -119,18 +174,45 @@ class Element:
 
         return self.fields[item]
 
+    def invalidate(self):
+        """
+        Method to mark the associated clip as outdated so it is rebuilt on next use
+        :return: None
+        """
+        self._dirty = True
+
     def update_clip(self):
         """
         Method to update the clip associated with this Element
         :return: None
         """
-        self._clip = generate_text(**self.fields)
+        if self.cache is not None:
+            # reuse the rasterized overlay and only apply placement and timing
+            self._clip = self.cache.render(self.fields).set_position(self.fields['position'])\
+                .set_start(self.fields['start']).set_duration(self.fields['duration'])
+        else:
+            self._clip = generate_text(**self.fields)
+
+        self._dirty = False
+
+    def placed(self, **placement):
+        """
+        Method to get a copy of this Element with another position or timing, sharing the already built clip
+        :param placement: values for 'position', 'start' and 'duration'
+        :return: Element
+        """
+        element = type(self)(**dict(self.fields, **placement))
+
+        # only placement and timing differ, so the clip is the same one moved and retimed
+        element._clip = self.get_clip().set_position(element['position']).set_start(element['start'])\
+            .set_duration(element['duration'])
+        element._dirty = False
+
+        return element
 
     # method to import values from a dictionary
     def import_values(self, import_dict):
-        for key, value in import_dict.items():
-            if key in self.fields:
-                self.__setitem__(key, value)
+        self.update(**{key: value for key, value in import_dict.items() if key in self.fields})
 
     def export_values(self):
         """
@@ -141,18 +223,28 @@ class Element:
 
     def get_clip(self):
         """
-        Method to get the associated clip
+        Method to get the associated clip, building it first if any field has changed
         :return: clip
         """
+        if self._dirty:
+            self.update_clip()
+
         return self._clip
 
+    def get_overlay(self):
+        """
+        Method to get the associated clip rasterized as an RGBA array
+        :return: RGBA array
+        """
+        return rasterize(self.get_clip())
+
     def to_image(self, filename):
         """
         Method to save the clip as an image
         :param filename: name for the file
         :return: None
         """
-        self._clip.save_frame(filename)
+        self.get_clip().save_frame(filename)
 
     def to_string(self):
         """
@@ -250,11 +342,17 @@ class Short:
         """
         return self._video
 
-    def compile_elements(self):
+    def compile_elements(self, vectorized: bool = True):
         """
         Method to compile the elements into a composite video
+        :param vectorized: blend the static overlays with NumPy instead of MoviePy compositing, only used when every
+                           element has a fixed position
         :return: compiled video clip
         """
+        if vectorized and self.has_static_positions():
+            with stage('compile'):
+                return StaticCompositor(self._video, self.get_overlays()).to_clip()
+
         compiled_elements = [self._video]
 
         for element in self._elements:
@@ -262,129 +360,394 @@ class Short:
 
         return CompositeVideoClip(compiled_elements).set_duration(self._video.duration)
 
-    def render(self, title: str):
+    def get_overlays(self):
+        """
+        Method to rasterize the elements
+        :return: list of (RGBA array, position, start, end) tuples, bottom element first
+        """
+        return [(element.get_overlay(), element['position'], element['start'],
+                 element['start'] + element['duration']) for element in self._elements]
+
+    def has_static_positions(self):
         """
-        Method to render the composition to a video file
+        Method to check whether every element has a fixed position, as opposed to a function of time
+        :return: True if every position is an (x, y) pair of numbers or alignment names
+        """
+        return all(isinstance(element['position'], (tuple, list)) and len(element['position']) == 2 and
+                   all(isinstance(value, (int, float, str)) for value in element['position'])
+                   for element in self._elements)
+
+    def supports_filtergraph(self):
+        """
+        Method to check whether the composition can be rendered by the ffmpeg filtergraph backend
+        :return: True if the background is an untransformed video file and every element has a fixed position
+        """
+        return is_plain_clip(self._video) and self.has_static_positions()
+
+    def render(self, title: str, profile='publish', threads: int = None, scratch: str = None, targets: list = None,
+               backend: str = RENDER_BACKEND):
+        """
+        Method to render the composition to a video file, or to several files from the same frames
         :param title: title of the video
+        :param profile: RenderProfile or name of a built-in profile ('draft' or 'publish')
+        :param threads: number of ffmpeg encoder threads, overrides the profile
+        :param scratch: directory for intermediate files
+        :param targets: optional list of OutputTargets or names of built-in targets ('shorts', 'tiktok', ...)
+        :param backend: 'moviepy', 'ffmpeg', or 'auto' to use ffmpeg unless the composition needs MoviePy
+        :return: path of the rendered video, or a list of paths in the order of the targets
+        """
+
+        if backend not in ('moviepy', 'ffmpeg', 'auto'):
+            raise ValueError(f'Unknown render backend: "{backend}"')
+
+        if backend == 'ffmpeg' and not self.supports_filtergraph():
+            raise ValueError('The composition cannot be rendered by the ffmpeg backend')
+
+        if targets is None:
+            outputs = [(output_path(title), None)]
+        else:
+            outputs = [(os.path.join('output', target.get_filename(title)), target)
+                       for target in map(get_target, targets)]
+
+        with stage('render'):
+            if backend != 'moviepy' and self.supports_filtergraph():
+                with stage('compile'):
+                    overlays = self.get_overlays()
+
+                # the background file is read by ffmpeg itself, the clip only provides its size and duration
+                video = self._video
+                encoder = functools.partial(encode_filtergraph, self._video.filename, overlays, self._audio,
+                                            self._video.duration, tuple(self._video.size))
+            else:
+                video = self.compile_elements()
+                encoder = None
+
+            export_videos(outputs, video, self._audio, profile=profile, threads=threads, scratch=scratch,
+                          encoder=encoder)
+
+        if targets is None:
+            return outputs[0][0]
+
+        return [filename for filename, _ in outputs]
+
+
+class ShortTemplate:
+    # fields stored as lists in JSON/YAML which Element expects as tuples
+    tuple_fields = ('box_size', 'bg_padding', 'bg_color', 'position')
+
+    # maximum number of prepared Elements kept for reuse
+    max_prepared = 128
+
+    def __init__(self, layout: dict):
+        """
+        Constructor for the ShortTemplate class.
+
+        :param layout: layout with a list of 'layers', where one layer may be {'captions': {...}} holding the
+                       caption style, and an optional 'transition_timing'
         :return: None
         """
+        self._transition_timing = float(layout.get('transition_timing', 0.5))
+        self._layers = []
+
+        for layer in layout.get('layers', []):
+            if 'captions' in layer:
+                self._layers.append(('captions', self.parse_fields(layer['captions'])))
+            else:
+                self._layers.append(('element', self.parse_fields(layer)))
+
+        # Elements built from the template, reused while their style stays the same
+        self._prepared = {}
+
+    def get_transition_timing(self):
+        """
+        Method to get the template's transition timing between captions
+
+        :return: transition timing in seconds
+        """
+        return self._transition_timing
 
-        # write to temporary files
-        self.compile_elements().write_videofile('temp.mp4')
-        self._audio.write_audiofile('temp.mp3')
+    @classmethod
+    def load(cls, path: str):
+        """
+        Method to load a template from a JSON or YAML file
 
-        # construct command
-        command = ['ffmpeg',
-                   '-y',
-                   '-i', "temp.mp4",
-                   '-i', "temp.mp3",
-                   '-c:v', 'copy',
-                   '-c:a', 'aac',
-                   '-shortest',
-                   'output/' + title + '.mp4']
+        :param path: path of the template file
+        :return: created instance
+        """
+        with open(path, 'r') as infile:
+            if path.endswith(('.yaml', '.yml')):
+                import yaml
+                layout = yaml.safe_load(infile)
+            else:
+                layout = json.load(infile)
 
-        # run the ffmpeg command
-        subprocess.run(command)
+        return cls(layout)
 
-        # remove temporary files
-        os.remove('temp.mp3')
-        os.remove('temp.mp4')
+    @classmethod
+    def parse_fields(cls, fields: dict):
+        """
+        Method to convert and validate the Element fields of a layer
 
+        :param fields: layer fields
+        :return: validated fields
+        """
+        parsed = {}
 
-def export_video(filename: str, video: VideoClip, audio: AudioClip):
+        for key, value in fields.items():
+            if key in cls.tuple_fields and isinstance(value, list):
+                value = tuple(value)
+
+            if key not in Element.field_defaults:
+                raise ValueError(f'Unknown field in template: "{key}"')
+
+            Element.check_field(key, value)
+            parsed[key] = value
+
+        return parsed
+
+    def get_element(self, index: int, fields: dict):
+        """
+        Method to get an Element for a layer, reusing the clip of one built earlier with the same style
+
+        :param index: index of the layer
+        :param fields: fields of the Element
+        :return: Element
+        """
+        # placement and timing change with every short and are applied to the prepared clip
+        style = {name: value for name, value in fields.items() if name in STYLE_FIELDS}
+        key = (index, json.dumps(style, sort_keys=True, default=str))
+        element = self._prepared.get(key)
+
+        if element is None:
+            if len(self._prepared) >= self.max_prepared:
+                self._prepared.clear()
+
+            element = Element(**fields)
+            self._prepared[key] = element
+
+        # a copy, as earlier shorts may still hold the prepared Element with their own timing
+        return element.placed(**{name: value for name, value in fields.items() if name not in STYLE_FIELDS})
+
+    def fill(self, video: VideoClip, audio: AudioClip, data: dict, duration: float = None,
+             transition_timing: float = None, beats: list = None):
+        """
+        Method to produce a Short from the template
+
+        :param video: video clip
+        :param audio: audio clip
+        :param data: values for the placeholders in layer texts, and the list of 'captions'
+        :param duration: duration of the Short, defaults to the duration of the video
+        :param transition_timing: transition timing between captions, defaults to the template's
+        :param beats: optional beats of the audio clip in seconds, caption changes are snapped to nearby ones
+        :return: filled Short
+        """
+        duration = video.duration if duration is None else duration
+        transition_timing = self._transition_timing if transition_timing is None else transition_timing
+
+        short = Short(video, audio)
+
+        for i, (kind, fields) in enumerate(self._layers):
+            if kind == 'captions':
+                # every caption stays on screen for a share of the time proportional to its reading time
+                slots = caption_slots(data['captions'], duration, transition_timing)
+
+                if beats:
+                    slots = snap_slots(slots, beats, transition_timing)
+
+                # captions change with every short, so they are never reused
+                for text, (start, length) in zip(data['captions'], slots):
+                    short.add_element(Element(**dict(fields, text=text, start=start, duration=length)))
+            else:
+                values = dict(fields)
+                values['text'] = fields.get('text', '').format(**data)
+                values.setdefault('duration', duration)
+
+                short.add_element(self.get_element(i, values))
+
+        return short
+
+
+def snap_slots(slots: tuple, beats: list, transition_timing: float, tolerance: float = BEAT_SNAP):
+    """
+    Function to move caption changes onto nearby beats, keeping the transitions between captions
+
+    :param slots: tuple of (start, duration) per caption
+    :param beats: beats in seconds from the start of the video
+    :param transition_timing: transition timing between captions
+    :param tolerance: maximum distance a caption change is moved
+    :return: tuple of (start, duration) per caption
+    """
+    starts = [start for start, _ in slots]
+    end = slots[-1][0] + slots[-1][1]
+
+    for i in range(1, len(starts)):
+        beat = min(beats, key=lambda b: abs(b - starts[i]))
+
+        # both neighbouring captions must stay on screen
+        following = starts[i + 1] - transition_timing if i + 1 < len(starts) else end
+
+        if abs(beat - starts[i]) <= tolerance and starts[i - 1] < beat - transition_timing and beat < following:
+            starts[i] = beat
+
+    ends = [start - transition_timing for start in starts[1:]] + [end]
+
+    return tuple((start, stop - start) for start, stop in zip(starts, ends))
+
+
+@functools.lru_cache(maxsize=None)
+def get_template(path: str):
+    """
+    Function to get a template, loading and validating it only once
+
+    :param path: path of the template file
+    :return: ShortTemplate
+    """
+    return ShortTemplate.load(path)
+
+
+def export_video(filename: str, video: VideoClip, audio: AudioClip, profile='publish', threads: int = None,
+                 scratch: str = None):
     """
     Exports a video given the filename, video component, and audio component.
 
+    The frames are streamed into a single ffmpeg process which encodes video and audio together into a
+    temporary file next to the destination, which then replaces the destination so a partial file is
+    never left behind.
+
     :param filename: name for the new file
     :param video: video clip
     :param audio: audio clip
+    :param profile: RenderProfile or name of a built-in profile
+    :param threads: number of ffmpeg encoder threads, overrides the profile
+    :param scratch: directory for intermediate files, defaults to the destination directory
     :return: None
     """
 
-    # write to temporary files
-    video.write_videofile('temp.mp4')
-    audio.write_audiofile('temp.mp3')
+    export_videos([(filename, None)], video, audio, profile=profile, threads=threads, scratch=scratch)
 
-    # construct command
-    command = ['ffmpeg',
-               '-y',
-               '-i', "temp.mp4",
-               '-i', "temp.mp3",
-               '-c:v', 'copy',
-               '-c:a', 'aac',
-               '-shortest',
-               filename]
 
-    # run ffmpeg command
-    subprocess.run(command)
+def export_videos(outputs: list, video: VideoClip, audio: AudioClip, profile='publish', threads: int = None,
+                  scratch: str = None, encoder=None):
+    """
+    Exports a video to several files at once, compositing every frame only once.
+
+    :param outputs: list of (filename, OutputTarget or None to use the frames and profile unchanged)
+    :param video: video clip
+    :param audio: audio clip
+    :param profile: RenderProfile or name of a built-in profile, the base of every target's settings
+    :param threads: number of ffmpeg encoder threads per output, overrides the profile
+    :param scratch: directory for intermediate files, defaults to the directory of the first file
+    :param encoder: optional function (encoder outputs, fps, scratch) replacing the encode of the video's frames
+    :return: None
+    """
+
+    profile = get_profile(profile)
+
+    if threads is not None:
+        profile = profile.copy(threads=threads)
+
+    width, height = video.size
+    encoder_outputs = []
+    temp_videos = []
+
+    for filename, target in outputs:
+        directory, name = os.path.split(filename)
+        os.makedirs(directory or '.', exist_ok=True)
 
-    # remove temporary files
-    os.remove('temp.mp3')
-    os.remove('temp.mp4')
+        # temporary name unique to this process so concurrent renders do not collide
+        base, extension = os.path.splitext(name)
+        temp_video = os.path.join(directory, '.' + base + '.' + str(os.getpid()) + (extension or '.mp4'))
+        temp_videos.append(temp_video)
 
+        if target is None:
+            encoder_outputs.append((temp_video, profile, None, None))
+        else:
+            encoder_outputs.append((temp_video, target.get_profile(profile), target.video_filter(width, height),
+                                    target.get_muxer()))
+
+    if scratch is None:
+        scratch = os.path.dirname(outputs[0][0]) or None
+
+    try:
+        if encoder is None:
+            encode_outputs(video, audio, encoder_outputs, profile.fps, scratch=scratch)
+        else:
+            encoder(encoder_outputs, profile.fps, scratch=scratch)
+
+        # move the finished files into place
+        for temp_video, (filename, _) in zip(temp_videos, outputs):
+            os.replace(temp_video, filename)
+    finally:
+        for temp_video in temp_videos:
+            if os.path.exists(temp_video):
+                os.remove(temp_video)
 
-def generate_fact_video(duration: float, data: dict, transition_timing=0.5):
+
+def generate_fact_video(duration: float, data: dict, transition_timing: float = None, profile='publish',
+                        threads: int = None, scratch: str = None, targets: list = None, backend: str = RENDER_BACKEND):
     """
     Function to generate a video based on data
 
     :param duration: duration of the video
     :param data: data to be displayed
-    :param transition_timing: transition timing between captions
-    :return: None
+    :param transition_timing: transition timing between captions, defaults to the template's
+    :param profile: RenderProfile or name of a built-in profile
+    :param threads: number of ffmpeg encoder threads
+    :param scratch: directory for intermediate files
+    :param targets: optional list of output targets, each rendered from the same frames
+    :param backend: render backend, 'moviepy', 'ffmpeg' or 'auto'
+    :return: path of the rendered video, or a list of paths if targets are given
     """
-    # create a Short object with random video and audio clips
-    short = Short(random_video_clip(duration), random_audio_clip(duration))
-
-    # add a title Element
-    short.add(text=data['topic'],
-              font_size=83,
-              radius=20,
-              text_color='black',
-              bg_color=(255, 255, 255),
-              font='Oswald-Medium',
-              position=('center', 200),
-              duration=duration)
-
-    num_captions = len(data['captions'])
-
-    # calculate the duration for each segment (except the last one)
-    segment_duration = (duration - transition_timing * (num_captions - 1)) / num_captions
-
-    for i in range(num_captions):
-        if i == num_captions - 1:
-            # last segment covers the remaining duration
-            segment_end = duration
-        else:
-            # calculate the end time for this segment
-            segment_end = i * (segment_duration + transition_timing) + segment_duration
-
-        # add a caption Element for each segment
-        short.add(
-            text=data['captions'][i],
-            font='Lato-Black',
-            radius=0,
-            box_size=(720, None),
-            font_size=75,
-            bg_opacity=0,
-            text_color='white',
-            stroke_color='black',
-            text_type='caption',
-            stroke_width=3,
-            position=('center', 'center'),
-            start=i * (segment_duration + transition_timing),
-            duration=segment_end - (i * (segment_duration + transition_timing))
-        )
-
-    # add a footer credit Element
-    short.add(text=data['channel'],
-              font_size=50,
-              text_type='label',
-              bg_padding=(60, 30),
-              radius=25,
-              position=('center', 1600),
-              duration=duration)
-
-    # render the video
-    short.render(data['captions'][0] + ' #shorts')
-
-    return 'output/' + data['captions'][0] + ' #shorts.mp4'
+    # intermediate media lives in a scratch directory which is removed once the short is rendered
+    owns_scratch = scratch is None
+    if owns_scratch:
+        scratch = tempfile.mkdtemp(prefix='short-')
+
+    try:
+        return build_fact_video(duration, data, transition_timing, scratch).render(
+            fact_video_title(data), profile=profile, threads=threads, scratch=scratch, targets=targets,
+            backend=backend)
+    finally:
+        if owns_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def output_path(title: str):
+    """
+    Function to get the path a video with a given title is rendered to
+
+    :param title: title of the video
+    :return: path of the video
+    """
+    return 'output/' + title + '.mp4'
+
+
+def fact_video_title(data: dict):
+    """
+    Function to get the title of a fact video
+
+    :param data: data to be displayed
+    :return: title of the video
+    """
+    return data['captions'][0] + ' #shorts'
+
+
+def build_fact_video(duration: float, data: dict, transition_timing: float, scratch: str):
+    """
+    Function to build the composition of a fact video
+
+    :param duration: duration of the video
+    :param data: data to be displayed
+    :param transition_timing: transition timing between captions, None for the template's
+    :param scratch: directory for intermediate files
+    :return: composed Short
+    """
+    # select random video and audio clips
+    with stage('select_video'):
+        video = random_video_clip(duration, scratch)
+
+    with stage('select_audio'):
+        audio, beats = random_audio_window(duration)
+
+    # lay out the title, captions and footer credit from the template, changing captions on the beat
+    return get_template(FACT_TEMPLATE).fill(video, audio, data, duration, transition_timing, beats)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+glyphs.py
+
+Text rendering backend which rasterizes each glyph once with Pillow/FreeType and composes captions from the
+cached glyphs, as an alternative to spawning ImageMagick for every TextClip.
+"""
+
+import os
+import functools
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# directory searched for font files named after the ImageMagick font names, e.g. 'Lato-Bold.ttf'
+FONT_DIR = os.getenv('FONT_DIR', 'fonts')
+
+
+def find_font(font: str):
+    """
+    Finds the font file for a font name.
+
+    :param font: Font name as used with ImageMagick, or a path to a font file
+    :return: Path of the font file
+    """
+
+    if os.path.isfile(font):
+        return font
+
+    for extension in ('.ttf', '.otf'):
+        path = os.path.join(FONT_DIR, font + extension)
+
+        if os.path.isfile(path):
+            return path
+
+    raise FileNotFoundError(f'No font file found for "{font}" in "{FONT_DIR}"')
+
+
+class GlyphAtlas:
+    def __init__(self, font: str, font_size: int, stroke_width: int = 0):
+        """
+        Constructor for the GlyphAtlas class.
+
+        :param font: font name or path of the font file
+        :param font_size: font size in pixels
+        :param stroke_width: width of the outline
+        :return: None
+        """
+        self._font = ImageFont.truetype(find_font(font), font_size)
+        self._stroke_width = stroke_width
+
+        ascent, descent = self._font.getmetrics()
+        self.line_height = ascent + descent + 2 * stroke_width
+
+        # character to (fill mask, outline mask, (x offset, y offset), advance)
+        self._glyphs = {}
+
+    def glyph(self, char: str):
+        """
+        Method to get a glyph, rasterizing it the first time it is used
+
+        :param char: character
+        :return: tuple of (fill mask, outline mask, (x offset, y offset), advance)
+        """
+        cached = self._glyphs.get(char)
+
+        if cached is not None:
+            return cached
+
+        left, top, right, bottom = self._font.getbbox(char, stroke_width=self._stroke_width, anchor='la')
+        size = (max(right - left, 0), max(bottom - top, 0))
+
+        if size[0] == 0 or size[1] == 0:
+            fill = outline = np.zeros((0, 0), dtype='float32')
+        else:
+            fill_image = Image.new('L', size, 0)
+            ImageDraw.Draw(fill_image).text((-left, -top), char, font=self._font, fill=255, anchor='la')
+
+            outline_image = Image.new('L', size, 0)
+            ImageDraw.Draw(outline_image).text((-left, -top), char, font=self._font, fill=255, anchor='la',
+                                               stroke_width=self._stroke_width, stroke_fill=255)
+
+            fill = np.asarray(fill_image, dtype='float32') / 255
+            outline = np.asarray(outline_image, dtype='float32') / 255
+
+        cached = (fill, outline, (left, top), self._font.getlength(char))
+        self._glyphs[char] = cached
+
+        return cached
+
+    def measure(self, text: str):
+        """
+        Method to measure the width of a line of text
+
+        :param text: line of text
+        :return: width in pixels, including the outline on both sides
+        """
+        return int(round(sum(self.glyph(char)[3] for char in text))) + 2 * self._stroke_width
+
+    def wrap(self, text: str, width: int):
+        """
+        Method to break text into lines no wider than a given width
+
+        :param text: text to be wrapped
+        :param width: maximum line width in pixels, or None to only break at newlines
+        :return: list of lines
+        """
+        lines = []
+
+        for paragraph in text.split('\n'):
+            if width is None:
+                lines.append(paragraph)
+                continue
+
+            line = ''
+            for word in paragraph.split(' '):
+                candidate = word if not line else line + ' ' + word
+
+                if line and self.measure(candidate) > width:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = candidate
+
+            lines.append(line)
+
+        return lines
+
+    def render(self, text: str, color: str, stroke_color: str = None, box_size: tuple = (None, None)):
+        """
+        Method to compose a text bitmap from the cached glyphs
+
+        :param text: text to be rendered
+        :param color: color of the text
+        :param stroke_color: color of the outline
+        :param box_size: size of the text box as (width, height), None lets a dimension fit the text
+        :return: RGBA array with centered lines
+        """
+        box_width, box_height = box_size
+
+        lines = self.wrap(text, box_width)
+        widths = [self.measure(line) for line in lines]
+
+        width = box_width if box_width is not None else max(widths)
+        height = box_height if box_height is not None else self.line_height * len(lines)
+
+        fill = np.zeros((height, width), dtype='float32')
+        outline = np.zeros((height, width), dtype='float32')
+
+        # center the block of lines vertically and every line horizontally
+        y = (height - self.line_height * len(lines)) // 2 + self._stroke_width
+
+        for line, line_width in zip(lines, widths):
+            pen = (width - line_width) / 2 + self._stroke_width
+
+            for char in line:
+                glyph_fill, glyph_outline, (left, top), advance = self.glyph(char)
+                gx = int(round(pen)) + left
+                gy = y + top
+                pen += advance
+
+                if glyph_fill.size == 0:
+                    continue
+
+                # part of the glyph inside the canvas
+                x0, y0 = max(gx, 0), max(gy, 0)
+                x1, y1 = min(gx + glyph_fill.shape[1], width), min(gy + glyph_fill.shape[0], height)
+
+                if x1 <= x0 or y1 <= y0:
+                    continue
+
+                source = (slice(y0 - gy, y1 - gy), slice(x0 - gx, x1 - gx))
+                np.maximum(fill[y0:y1, x0:x1], glyph_fill[source], out=fill[y0:y1, x0:x1])
+                np.maximum(outline[y0:y1, x0:x1], glyph_outline[source], out=outline[y0:y1, x0:x1])
+
+            y += self.line_height
+
+        fill_rgb = np.array(ImageColor.getrgb(color)[:3], dtype='float32')
+        fill = fill[:, :, None]
+
+        if stroke_color is not None and self._stroke_width > 0:
+            stroke_rgb = np.array(ImageColor.getrgb(stroke_color)[:3], dtype='float32')
+            outline = outline[:, :, None]
+
+            # the fill is drawn over the outline
+            alpha = fill + outline * (1 - fill)
+            rgb = (fill_rgb * fill + stroke_rgb * outline * (1 - fill)) / np.maximum(alpha, 1e-6)
+        else:
+            alpha = fill
+            rgb = np.broadcast_to(fill_rgb, (height, width, 3))
+
+        return np.dstack([rgb, alpha * 255]).round().astype('uint8')
+
+
+@functools.lru_cache(maxsize=32)
+def get_atlas(font: str, font_size: int, stroke_width: int = 0):
+    """
+    Gets the shared glyph atlas for a font, size and outline width.
+
+    :param font: Font name or path of the font file
+    :param font_size: Font size in pixels
+    :param stroke_width: Width of the outline
+    :return: GlyphAtlas
+    """
+
+    return GlyphAtlas(font, font_size, stroke_width)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""
+jobs.py
+
+Persistent, crash-safe queue of shorts moving through the selected, rendered, packaged and uploaded states.
+"""
+
+import os
+import json
+import time
+import random
+import socket
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# states a job moves through, in order
+STATES = ('selected', 'rendered', 'packaged', 'uploaded')
+
+# location of the queue database
+JOB_QUEUE = os.getenv('JOB_QUEUE', 'jobs.db')
+
+
+class JobQueue:
+    def __init__(self, database: str = JOB_QUEUE, lease: float = 3600, max_attempts: int = 3):
+        """
+        Constructor for the JobQueue class.
+
+        :param database: path of the SQLite database
+        :param lease: seconds after which a claim of a crashed worker may be taken over
+        :param max_attempts: number of failures after which a job is no longer claimed
+        :return: None
+        """
+        self._lease = lease
+        self._max_attempts = max_attempts
+
+        # autocommit mode, transactions are opened explicitly where needed
+        self._connection = sqlite3.connect(database, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        key TEXT NOT NULL UNIQUE,
+                                        state TEXT NOT NULL,
+                                        duration REAL NOT NULL,
+                                        data TEXT NOT NULL,
+                                        output TEXT,
+                                        result TEXT,
+                                        attempts INTEGER NOT NULL DEFAULT 0,
+                                        error TEXT,
+                                        claimed_by TEXT,
+                                        claimed_at REAL,
+                                        updated REAL NOT NULL
+                                    )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, claimed_by)')
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def decode(row: sqlite3.Row):
+        """
+        Method to convert a database row into a job dictionary
+
+        :param row: database row
+        :return: job dictionary
+        """
+        job = dict(row)
+        job['data'] = json.loads(job['data'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+
+        return job
+
+    def add(self, key: str, duration: float, data: dict):
+        """
+        Method to add a selected short, doing nothing if a job with the same key exists
+
+        :param key: unique key of the short, such as its title
+        :param duration: duration of the short
+        :param data: data to be displayed
+        :return: True if the job was added
+        """
+        with self._lock:
+            cursor = self._connection.execute('INSERT OR IGNORE INTO jobs (key, state, duration, data, updated) '
+                                              'VALUES (?, ?, ?, ?, ?)',
+                                              (key, STATES[0], duration, json.dumps(data), time.time()))
+
+        return cursor.rowcount == 1
+
+    def claim(self, state: str, worker: str):
+        """
+        Method to claim the oldest unclaimed job in a state
+
+        :param state: state of the job
+        :param worker: name of the claiming worker
+        :return: job dictionary or None if there is nothing to claim
+        """
+        now = time.time()
+
+        with self._lock:
+            # an immediate transaction keeps other processes from claiming the same job
+            self._connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                row = self._connection.execute('SELECT * FROM jobs WHERE state = ? AND attempts < ? AND '
+                                               '(claimed_by IS NULL OR claimed_at < ?) ORDER BY id LIMIT 1',
+                                               (state, self._max_attempts, now - self._lease)).fetchone()
+
+                if row is not None:
+                    self._connection.execute('UPDATE jobs SET claimed_by = ?, claimed_at = ? WHERE id = ?',
+                                             (worker, now, row['id']))
+
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        return self.decode(row) if row is not None else None
+
+    def complete(self, job_id: int, state: str, output: str = None, result=None):
+        """
+        Method to move a claimed job into its next state and release the claim
+
+        :param job_id: id of the job
+        :param state: new state of the job
+        :param output: path of the rendered video, kept if None
+        :param result: JSON-serializable result of the stage, kept if None
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET state = ?, output = COALESCE(?, output), '
+                                     'result = COALESCE(?, result), attempts = 0, error = NULL, claimed_by = NULL, '
+                                     'claimed_at = NULL, updated = ? WHERE id = ?',
+                                     (state, output, json.dumps(result) if result is not None else None, time.time(),
+                                      job_id))
+
+    def checkpoint(self, job_id: int, result):
+        """
+        Method to save the progress of a claimed job, so an attempt after a crash can continue from it
+
+        :param job_id: id of the job
+        :param result: JSON-serializable progress of the stage
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET result = ?, updated = ? WHERE id = ?',
+                                     (json.dumps(result), time.time(), job_id))
+
+    def release_dead(self, host: str):
+        """
+        Method to release the claims of workers on a host whose process is no longer running
+
+        :param host: name of the host, worker names start with the host and the process id
+        :return: number of released claims
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT id, claimed_by FROM jobs WHERE claimed_by LIKE ?',
+                                            (host + ':%',)).fetchall()
+
+            dead = [row['id'] for row in rows if not process_alive(int(row['claimed_by'].split(':')[1]))]
+
+            self._connection.executemany('UPDATE jobs SET claimed_by = NULL, claimed_at = NULL WHERE id = ?',
+                                         [(job_id,) for job_id in dead])
+
+        return len(dead)
+
+    def fail(self, job_id: int, error: str):
+        """
+        Method to record a failed attempt and release the claim so the job can be retried
+
+        :param job_id: id of the job
+        :param error: description of the error
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET attempts = attempts + 1, error = ?, claimed_by = NULL, '
+                                     'claimed_at = NULL, updated = ? WHERE id = ?', (error, time.time(), job_id))
+
+    def pending(self, states: tuple):
+        """
+        Method to count the jobs in some states which may still be worked on
+
+        :param states: states to be counted
+        :return: number of jobs
+        """
+        with self._lock:
+            return self._connection.execute(f'SELECT COUNT(*) FROM jobs WHERE attempts < ? AND state IN '
+                                            f'({", ".join("?" * len(states))})',
+                                            (self._max_attempts,) + tuple(states)).fetchone()[0]
+
+    def get_counts(self):
+        """
+        Method to get the number of jobs in every state
+
+        :return: dictionary of state to number of jobs
+        """
+        with self._lock:
+            counts = dict(self._connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+        return {state: counts.get(state, 0) for state in STATES}
+
+    def get_jobs(self, state: str = None):
+        """
+        Method to get every job, optionally only those in one state
+
+        :param state: state of the jobs
+        :return: list of job dictionaries
+        """
+        with self._lock:
+            if state is None:
+                rows = self._connection.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+            else:
+                rows = self._connection.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id', (state,)).fetchall()
+
+        return [self.decode(row) for row in rows]
+
+
+def process_alive(pid: int):
+    """
+    Checks whether a process is running on this host.
+
+    :param pid: Process id
+    :return: True if the process exists
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, but owned by another user
+        return True
+
+    return True
+
+
+def stage_worker(database: str, state: str, handler, worker: str, poll: float = 1.0):
+    """
+    Works on the jobs of one state until no job can reach it anymore.
+
+    The handler is called with the job dictionary and returns a (output, result) tuple. It must be safe to call
+    again for a job whose earlier attempt crashed, for example by returning an output which already exists.
+
+    :param database: Path of the queue database
+    :param state: State of the jobs to work on
+    :param handler: Function moving a job into the next state
+    :param worker: Name of the worker
+    :param poll: Seconds to wait when jobs are still on their way to this state
+    :return: Number of jobs completed
+    """
+
+    # forked workers inherit the parent's random state, reseed so they pick different media
+    random.seed()
+
+    queue = JobQueue(database)
+    next_state = STATES[STATES.index(state) + 1]
+    upstream = STATES[:STATES.index(state) + 1]
+    completed = 0
+
+    while True:
+        job = queue.claim(state, worker)
+
+        if job is None:
+            if queue.pending(upstream) == 0:
+                return completed
+
+            # jobs are still in earlier stages or claimed by other workers
+            time.sleep(poll)
+            continue
+
+        try:
+            output, result = handler(job)
+        except Exception as e:
+            print(f"Job {job['id']} failed in state {state}: {str(e)}")
+            queue.fail(job['id'], str(e))
+            continue
+
+        queue.complete(job['id'], next_state, output, result)
+        completed += 1
+
+
+def run_stages(database: str, stages: dict):
+    """
+    Runs several stages of the queue at once, each with its own number of workers.
+
+    :param database: Path of the queue database
+    :param stages: Dictionary of state to (handler, workers, use_processes), CPU-heavy stages should use processes
+    :return: Dictionary of state to number of jobs completed
+    """
+
+    host = socket.gethostname() + ':' + str(os.getpid())
+    executors = []
+    futures = {}
+
+    # jobs claimed by a run on this host which crashed can be retried now instead of after the lease
+    released = JobQueue(database).release_dead(socket.gethostname())
+
+    if released:
+        print(f"Released {released} jobs claimed by crashed workers")
+
+    try:
+        for state, (handler, workers, use_processes) in stages.items():
+            executor = ProcessPoolExecutor(workers) if use_processes else ThreadPoolExecutor(workers)
+            executors.append(executor)
+
+            futures[state] = [executor.submit(stage_worker, database, state, handler, f'{host}:{state}:{i}')
+                              for i in range(workers)]
+
+        return {state: sum(future.result() for future in stage_futures) for state, stage_futures in futures.items()}
+    finally:
+        for executor in executors:
+            executor.shutdown()
@@ -3,16 +3,76 @@
 from data import *
 from generator import *
 from youtube import *
+from batch import *
+from jobs import *
+from timing import short_duration
 
+# number of workers packaging rendered shorts
+PACKAGE_WORKERS = int(os.getenv('PACKAGE_WORKERS', 1))
 
-def create_fact_video():
+# YouTube category id and privacy status of uploaded shorts
+UPLOAD_CATEGORY = os.getenv('UPLOAD_CATEGORY', '22')
+UPLOAD_STATUS = os.getenv('UPLOAD_STATUS', 'public')
+
+
+def fact_video_data():
     data = caption_video_data()
 
     data['channel'] = '@truethoughtsdaily'
 
-    file_path = generate_fact_video(10 if data['type'] == 'THREE' else 7, data)
+    return data
+
+
+def fact_video_duration(data: dict):
+    # long enough to read every caption, known before any media is selected, but no longer than the video library
+    return short_duration(data['captions'], get_template(FACT_TEMPLATE).get_transition_timing(),
+                          maximum=int(os.getenv('MAX_DURATION')))
+
+
+def create_fact_video():
+    data = fact_video_data()
+
+    file_path = generate_fact_video(fact_video_duration(data), data)
+
+    package_fact_video(data, file_path)
+
+
+def render_job_handler(job: dict):
+    file_path = output_path(fact_video_title(job['data']))
+
+    # outputs are written atomically, so an existing file is a finished render whose job was not updated
+    if os.path.exists(file_path):
+        return file_path, None
+
+    return generate_fact_video(job['duration'], job['data'], threads=FFMPEG_THREADS), None
+
 
-    package = {
+def package_job_handler(job: dict):
+    package_fact_video(job['data'], job['output'])
+
+    return None, None
+
+
+def upload_job_handler(job: dict):
+    package = fact_video_package(job['data'], job['output'])
+
+    # the upload session and video id are saved in the job, so a retry after a crash resumes instead of publishing
+    # the short twice
+    queue = JobQueue(JOB_QUEUE)
+
+    video_id = upload(package['video'], package['title'], package['description'], package['tags'],
+                      UPLOAD_CATEGORY, UPLOAD_STATUS, progress=dict(job['result'] or {}),
+                      checkpoint=lambda progress: queue.checkpoint(job['id'], progress))
+
+    return None, {'video_id': video_id}
+
+
+def package_fact_video(data: dict, file_path: str):
+    package_video(fact_video_package(data, file_path))
+
+
+def fact_video_package(data: dict, file_path: str):
+    return {
         'title': data['captions'][0] + '#shorts',
         'video': file_path,
         'description': '#truethoughtsdaily #inspiration #inspirationalquotes  #wisdomquotes #positivity '
@@ -29,9 +89,21 @@ def create_fact_video():
                  'thoughtfortoday ', 'quotes ', 'quotestoliveby ', 'wisdomforliving ', 'wisdomquote']
     }
 
-    package_video(package)
-
 
 if __name__ == '__main__':
-    for i in range(50):
-        create_fact_video()
+    # normalize new archive videos and decode new tracks before rendering
+    ingest_proxies()
+    get_audio_pool()
+
+    queue = JobQueue()
+
+    # select a new batch only once the previous one has been worked through, otherwise resume it
+    if queue.pending(('selected', 'rendered', 'packaged')) == 0:
+        for i in range(50):
+            data = fact_video_data()
+            queue.add(fact_video_title(data), fact_video_duration(data), data)
+
+    # rendering is CPU-bound and runs in processes, packaging and uploading are I/O-bound and run in threads
+    run_stages(JOB_QUEUE, {'selected': (render_job_handler, BATCH_WORKERS, True),
+                           'rendered': (package_job_handler, PACKAGE_WORKERS, False),
+                           'packaged': (upload_job_handler, UPLOAD_WORKERS, False)})
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+
+"""
+media.py
+
+Persistent index of the media archives, so clips can be selected without probing files.
+"""
+
+import os
+import json
+import math
+import time
+import bisect
+import hashlib
+import random
+import sqlite3
+import threading
+import functools
+import tempfile
+import subprocess
+import numpy as np
+from scenes import analyze_scenes
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# location of the index database
+MEDIA_INDEX = os.getenv('MEDIA_INDEX', 'media_index.db')
+
+# number of recently used segments per archive which are not picked again
+RECENT_WINDOW = int(os.getenv('RECENT_WINDOW', 20))
+
+
+def probe(path: str):
+    """
+    Reads the container and stream metadata of a media file with ffprobe.
+
+    :param path: Path of the media file
+    :return: Dictionary of duration, width, height, fps and codec
+    """
+
+    command = ['ffprobe',
+               '-v', 'error',
+               '-print_format', 'json',
+               '-show_format',
+               '-show_streams',
+               path]
+
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise IOError(f'ffprobe failed for "{path}": {result.stderr.strip()}')
+
+    info = json.loads(result.stdout)
+
+    # cover art embedded in audio files is a video stream too, but not part of the media
+    streams = [s for s in info.get('streams', []) if not s.get('disposition', {}).get('attached_pic')]
+
+    # prefer the video stream, fall back to the first stream for audio files
+    stream = next((s for s in streams if s.get('codec_type') == 'video'), streams[0] if streams else {})
+
+    fps = None
+    if stream.get('codec_type') == 'video' and stream.get('avg_frame_rate', '0/0') != '0/0':
+        num, den = stream['avg_frame_rate'].split('/')
+        fps = int(num) / int(den)
+
+    return {
+        'duration': float(info.get('format', {}).get('duration') or stream.get('duration') or 0),
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'fps': fps,
+        'codec': stream.get('codec_name')
+    }
+
+
+def content_hash(path: str, chunk: int = 1024 * 1024):
+    """
+    Computes the SHA-256 hash of a file's contents.
+
+    :param path: Path of the file
+    :param chunk: Number of bytes read at a time
+    :return: Hex digest
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(chunk), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def video_hash(path: str, duration: float, samples: int = 4):
+    """
+    Computes a perceptual hash from a few frames sampled evenly through a video.
+
+    Every frame is reduced to a 9x8 grayscale image and hashed by comparing neighbouring pixels (dHash), so
+    re-encodes, resizes and small color changes produce the same or a very close hash.
+
+    :param path: Path of the video
+    :param duration: Duration of the video
+    :param samples: Number of frames sampled
+    :return: Hex string of 64 bits per sampled frame
+    """
+
+    bits = []
+
+    for i in range(samples):
+        command = ['ffmpeg',
+                   '-v', 'error',
+                   '-ss', str(duration * (i + 0.5) / samples),
+                   '-i', path,
+                   '-frames:v', '1',
+                   '-vf', 'scale=9:8,format=gray',
+                   '-f', 'rawvideo',
+                   '-']
+
+        result = subprocess.run(command, capture_output=True)
+
+        if result.returncode != 0 or len(result.stdout) != 72:
+            raise IOError(f'ffmpeg failed to sample a frame of "{path}"')
+
+        pixels = np.frombuffer(result.stdout, dtype='uint8').reshape(8, 9).astype('int16')
+        bits.append((pixels[:, 1:] > pixels[:, :-1]).ravel())
+
+    return pack_bits(np.concatenate(bits))
+
+
+def audio_hash(path: str, seconds: int = 60, bands: int = 12, frames: int = 32, fps: int = 8000):
+    """
+    Computes a perceptual hash from the spectral energy of the start of a track.
+
+    :param path: Path of the track
+    :param seconds: Number of seconds analyzed
+    :param bands: Number of logarithmic frequency bands
+    :param frames: Number of time frames
+    :param fps: Sample rate the track is decoded at
+    :return: Hex string of bands * frames bits
+    """
+
+    command = ['ffmpeg',
+               '-v', 'error',
+               '-i', path,
+               '-t', str(seconds),
+               '-vn',
+               '-ac', '1',
+               '-ar', str(fps),
+               '-f', 'f32le',
+               '-']
+
+    result = subprocess.run(command, capture_output=True)
+
+    if result.returncode != 0:
+        raise IOError(f'ffmpeg failed to decode "{path}"')
+
+    samples = np.frombuffer(result.stdout, dtype='float32')
+    window = 2048
+
+    if len(samples) < window * frames:
+        samples = np.pad(samples, (0, window * frames - len(samples)))
+
+    # evenly spaced analysis windows and their spectra
+    starts = np.linspace(0, len(samples) - window, frames).astype(int)
+    spectra = np.abs(np.fft.rfft(samples[starts[:, None] + np.arange(window)] * np.hanning(window), axis=1))
+
+    # sum the spectrum into logarithmic bands between 60 Hz and the Nyquist frequency
+    edges = np.geomspace(60, fps / 2, bands + 1) * window / fps
+    edges = np.clip(edges.astype(int), 1, spectra.shape[1])
+    energy = np.add.reduceat(spectra, edges[:-1], axis=1)[:, :bands]
+
+    # a bit per band: louder than the frame's median band or not
+    return pack_bits((energy > np.median(energy, axis=1, keepdims=True)).ravel())
+
+
+def pack_bits(bits: np.ndarray):
+    """
+    Packs an array of booleans into a hex string.
+
+    :param bits: Array of booleans
+    :return: Hex string
+    """
+
+    return np.packbits(bits).tobytes().hex()
+
+
+def hamming(a: str, b: str):
+    """
+    Computes the number of differing bits between two perceptual hashes.
+
+    :param a: First hex string
+    :param b: Second hex string
+    :return: Number of differing bits, or None if the hashes cannot be compared
+    """
+
+    if not a or not b or len(a) != len(b):
+        return None
+
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class MediaIndex:
+    # columns added after the first version of the index, with their types
+    extra_columns = (('content_hash', 'TEXT'), ('perceptual_hash', 'TEXT'), ('scenes', 'TEXT'),
+                     ('analyzed', 'INTEGER'))
+
+    # columns stored as JSON
+    json_columns = ('scenes',)
+
+    # files analyzed by an older version of analyze() or probed by an older probe() are analyzed again
+    analysis_version = 3
+
+    # perceptual hashes closer than this fraction of their bits count as the same media
+    near_duplicate = 0.1
+
+    def __init__(self, directory: str, extensions: tuple, database: str = MEDIA_INDEX,
+                 recent_window: int = RECENT_WINDOW):
+        """
+        Constructor for the MediaIndex class.
+
+        :param directory: archive directory to index
+        :param extensions: file extensions to include
+        :param database: path of the SQLite database
+        :param recent_window: number of recently used segments which are not picked again
+        :return: None
+        """
+        self._directory = directory
+        self._extensions = extensions
+        self._database = database
+        self._recent_window = recent_window
+
+        # sqlite connections belong to the thread which opened them
+        self._local = threading.local()
+
+        connection = self.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS media (
+                                  path TEXT PRIMARY KEY,
+                                  directory TEXT NOT NULL,
+                                  duration REAL NOT NULL,
+                                  width INTEGER,
+                                  height INTEGER,
+                                  fps REAL,
+                                  codec TEXT,
+                                  mtime REAL NOT NULL
+                              )''')
+        connection.execute('CREATE INDEX IF NOT EXISTS media_directory ON media (directory, duration)')
+
+        # bring indexes created by earlier versions up to date
+        existing = {row['name'] for row in connection.execute('PRAGMA table_info(media)')}
+        for name, kind in self.extra_columns:
+            if name not in existing:
+                connection.execute(f'ALTER TABLE media ADD COLUMN {name} {kind}')
+
+        connection.execute('''CREATE TABLE IF NOT EXISTS recent (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  directory TEXT NOT NULL,
+                                  content_hash TEXT,
+                                  perceptual_hash TEXT,
+                                  start REAL NOT NULL,
+                                  end REAL NOT NULL,
+                                  used REAL NOT NULL
+                              )''')
+        connection.commit()
+
+        # entries sorted by duration, with cumulative durations for weighted picks
+        self._entries = []
+        self._durations = []
+        self._cumulative = []
+
+        self.refresh()
+
+    def connection(self):
+        """
+        Method to get the database connection of the current thread and process
+
+        :return: sqlite3 Connection
+        """
+        local = self._local
+
+        # connections must not be shared with forked worker processes
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            local.connection = sqlite3.connect(self._database, timeout=30)
+            local.connection.row_factory = sqlite3.Row
+            local.pid = os.getpid()
+
+        return local.connection
+
+    def analyze(self, path: str, info: dict):
+        """
+        Method to compute the fingerprints and, for videos, the shot analysis of a new or modified file
+
+        :param path: path of the file
+        :param info: probed metadata of the file
+        :return: dictionary of values for the extra columns
+        """
+        analysis = {'content_hash': content_hash(path), 'analyzed': self.analysis_version}
+
+        if info['width'] is not None:
+            analysis['perceptual_hash'] = video_hash(path, info['duration'])
+            analysis['scenes'] = analyze_scenes(path)
+        else:
+            analysis['perceptual_hash'] = audio_hash(path)
+
+        return analysis
+
+    def refresh(self):
+        """
+        Method to bring the index up to date, probing and analyzing only new, modified or outdated files
+
+        :return: None
+        """
+        connection = self.connection()
+
+        known = {row['path']: (row['mtime'], row['analyzed'] or 0) for row in
+                 connection.execute('SELECT path, mtime, analyzed FROM media WHERE directory = ?',
+                                    (self._directory,))}
+
+        present = set()
+
+        if os.path.isdir(self._directory):
+            for entry in os.scandir(self._directory):
+                if not entry.name.endswith(self._extensions):
+                    continue
+
+                present.add(entry.path)
+                mtime = entry.stat().st_mtime
+
+                if known.get(entry.path) == (mtime, self.analysis_version):
+                    continue
+
+                try:
+                    info = probe(entry.path)
+                    info.update(self.analyze(entry.path, info))
+                except (IOError, ValueError) as e:
+                    print(f"Error indexing media: {str(e)}")
+                    continue
+
+                info.update({'path': entry.path, 'directory': self._directory, 'mtime': mtime})
+
+                for name in self.json_columns:
+                    if info.get(name) is not None:
+                        info[name] = json.dumps(info[name])
+
+                columns = ', '.join(info.keys())
+                placeholders = ', '.join(':' + name for name in info.keys())
+                connection.execute(f'INSERT OR REPLACE INTO media ({columns}) VALUES ({placeholders})', info)
+
+        # forget files which were removed from the archive
+        for path in set(known) - present:
+            connection.execute('DELETE FROM media WHERE path = ?', (path,))
+
+        connection.commit()
+        self.load()
+
+    def load(self):
+        """
+        Method to load the indexed entries into memory, leaving out exact duplicates
+
+        :return: None
+        """
+        seen = set()
+        self._entries = []
+
+        for row in self.connection().execute('SELECT * FROM media WHERE directory = ? ORDER BY path',
+                                             (self._directory,)):
+            if row['content_hash'] is not None:
+                if row['content_hash'] in seen:
+                    continue
+
+                seen.add(row['content_hash'])
+
+            entry = dict(row)
+
+            for name in self.json_columns:
+                if entry[name] is not None:
+                    entry[name] = json.loads(entry[name])
+
+            self._entries.append(entry)
+
+        self._entries.sort(key=lambda entry: entry['duration'])
+        self._durations = [entry['duration'] for entry in self._entries]
+
+        self._cumulative = []
+        total = 0.0
+        for duration in self._durations:
+            total += duration
+            self._cumulative.append(total)
+
+    def get_entries(self):
+        """
+        Method to get every indexed entry
+
+        :return: list of entries sorted by duration
+        """
+        return self._entries
+
+    def find_duplicate(self, path: str):
+        """
+        Method to find an indexed file with the same contents as a given file
+
+        :param path: path of the file
+        :return: path of the indexed file or None
+        """
+        row = self.connection().execute('SELECT path FROM media WHERE content_hash = ? AND path != ? LIMIT 1',
+                                        (content_hash(path), path)).fetchone()
+
+        return row['path'] if row is not None else None
+
+    def pick(self, duration: float, weighted: bool = True):
+        """
+        Method to pick a random entry which is at least a given duration long
+
+        :param duration: minimum duration of the entry
+        :param weighted: weight entries by their duration so every second of the archive is equally likely
+        :return: the selected entry
+        """
+        first = bisect.bisect_left(self._durations, duration)
+
+        if first == len(self._entries):
+            raise FileNotFoundError('There are no files in "' + self._directory + '" with a duration of at least ' +
+                                    str(duration) + ' seconds')
+
+        if not weighted:
+            return self._entries[random.randrange(first, len(self._entries))]
+
+        # draw a point in the cumulative durations of the eligible entries
+        low = self._cumulative[first - 1] if first > 0 else 0.0
+        point = random.uniform(low, self._cumulative[-1])
+
+        return self._entries[min(bisect.bisect_right(self._cumulative, point), len(self._entries) - 1)]
+
+    def get_recent(self):
+        """
+        Method to get the most recently used segments of this archive, including those used by other processes
+
+        :return: list of recent segment dictionaries
+        """
+        return [dict(row) for row in self.connection().execute(
+            'SELECT * FROM recent WHERE directory = ? ORDER BY id DESC LIMIT ?',
+            (self._directory, self._recent_window))]
+
+    def is_recent(self, entry: dict, start: float, duration: float, recent: list):
+        """
+        Method to check whether a segment overlaps a recently used segment of the same or near-identical media
+
+        :param entry: entry of the file
+        :param start: start second of the segment
+        :param duration: duration of the segment
+        :param recent: recently used segments
+        :return: True if the segment was used recently
+        """
+        for used in recent:
+            same = entry['content_hash'] is not None and used['content_hash'] == entry['content_hash']
+
+            if not same:
+                distance = hamming(used['perceptual_hash'], entry['perceptual_hash'])
+                same = distance is not None and distance <= len(entry['perceptual_hash']) * 4 * self.near_duplicate
+
+            if same and start < used['end'] and used['start'] < start + duration:
+                return True
+
+        return False
+
+    def pick_segment(self, duration: float, align: float = None, attempts: int = 20, choose=None):
+        """
+        Method to pick a random segment, avoiding segments of the same media used recently
+
+        :param duration: duration of the segment
+        :param align: optional step the start is rounded down to, such as the keyframe interval
+        :param attempts: number of picks tried before accepting a recently used segment
+        :param choose: optional function (entry, duration) returning a start, or None if the entry has no usable one
+        :return: tuple of (entry, start second)
+        """
+        recent = self.get_recent()
+        picked = None
+
+        for _ in range(attempts):
+            entry = self.pick(duration)
+
+            if choose is not None:
+                start = choose(entry, duration)
+
+                if start is None:
+                    continue
+            else:
+                start = random.uniform(0, entry['duration'] - duration)
+
+                if align is not None:
+                    start = math.floor(start / align) * align
+
+            picked = (entry, start)
+
+            if not self.is_recent(entry, start, duration, recent):
+                break
+
+        if picked is None:
+            raise FileNotFoundError('No usable segment of ' + str(duration) + ' seconds was found in "' +
+                                    self._directory + '"')
+
+        entry, start = picked
+
+        connection = self.connection()
+        connection.execute('INSERT INTO recent (directory, content_hash, perceptual_hash, start, end, used) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (self._directory, entry['content_hash'],
+                                                         entry['perceptual_hash'], start, start + duration,
+                                                         time.time()))
+        connection.commit()
+
+        return entry, start
+
+
+@functools.lru_cache(maxsize=None)
+def get_media_index(directory: str, extensions: tuple):
+    """
+    Gets the shared index of an archive directory, building or refreshing it on first use.
+
+    :param directory: Archive directory
+    :param extensions: File extensions to include
+    :return: MediaIndex of the directory
+    """
+
+    return MediaIndex(directory, extensions)
+
+
+def scratch_file(scratch: str, suffix: str):
+    """
+    Creates an empty, uniquely named file for intermediate media.
+
+    :param scratch: Directory in which the file is created, or None for the system temporary directory
+    :param suffix: File extension including the dot
+    :return: Path of the file
+    """
+
+    handle, path = tempfile.mkstemp(suffix=suffix, dir=scratch)
+    os.close(handle)
+
+    return path
+
+
+def extract_segment(source: str, destination: str, start: float, duration: float, codec_args: list = None):
+    """
+    Cuts a segment out of a media file, seeking on the input side so nothing before the segment is decoded.
+
+    :param source: Path of the source file
+    :param destination: Path of the segment file
+    :param start: Start second of the segment
+    :param duration: Duration of the segment
+    :param codec_args: ffmpeg output arguments, stream copy is used when omitted
+    :return: None
+    """
+
+    command = ['ffmpeg',
+               '-y',
+               '-v', 'error',
+               '-ss', str(start),
+               '-i', source,
+               '-t', str(duration)]
+
+    if codec_args is None:
+        # only valid when the start lines up with a keyframe
+        command += ['-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    else:
+        command += codec_args
+
+    command.append(destination)
+
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise IOError(f'ffmpeg failed to extract a segment of "{source}": {result.stderr.strip()}')
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+pipeline.py
+
+Producer/consumer pipeline which prepares the next shorts while the current one is encoding.
+"""
+
+import time
+import queue
+import shutil
+import tempfile
+import threading
+from generator import *
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# marks the end of a stage's output
+DONE = object()
+
+
+class Pipeline:
+    def __init__(self, prefetch: int = 2, package=None, profile='publish', threads: int = None,
+                 transition_timing: float = None):
+        """
+        Constructor for the Pipeline class.
+
+        :param prefetch: number of prepared shorts which may wait for the encoder
+        :param package: optional function called with (data, file path) once a short is rendered
+        :param profile: RenderProfile or name of a built-in profile
+        :param threads: number of ffmpeg encoder threads
+        :param transition_timing: transition timing between captions, defaults to the template's
+        :return: None
+        """
+        self._prefetch = prefetch
+        self._package = package
+        self._profile = profile
+        self._threads = threads
+        self._transition_timing = transition_timing
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, depth: int = None):
+        """
+        Method to record the time a stage spent on one short and the depth of its output queue
+
+        :param stage: name of the stage
+        :param seconds: time spent
+        :param depth: number of items waiting in the stage's output queue
+        :return: None
+        """
+        with self._lock:
+            stats = self._stats.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                   'depth_total': 0, 'max_depth': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+            if depth is not None:
+                stats['depth_total'] += depth
+                stats['max_depth'] = max(stats['max_depth'], depth)
+
+    def get_stats(self):
+        """
+        Method to get the per-stage timing and queue depths of the last run
+
+        :return: dictionary of stage name to statistics
+        """
+        with self._lock:
+            stats = {}
+
+            for stage, values in self._stats.items():
+                stats[stage] = {
+                    'count': values['count'],
+                    'seconds': values['seconds'],
+                    'average_seconds': values['seconds'] / values['count'] if values['count'] else 0.0,
+                    'max_seconds': values['max_seconds'],
+                    'average_depth': values['depth_total'] / values['count'] if values['count'] else 0.0,
+                    'max_depth': values['max_depth']
+                }
+
+            return stats
+
+    def prepare(self, jobs: list, prepared: queue.Queue, results: list):
+        """
+        Method run by the preparation stage, selecting media and rendering overlays
+
+        :param jobs: list of (duration, data) tuples
+        :param prepared: queue feeding the encoding stage
+        :param results: list receiving errors
+        :return: None
+        """
+        for i, (duration, data) in enumerate(jobs):
+            start = time.perf_counter()
+            scratch = tempfile.mkdtemp(prefix='short-')
+
+            try:
+                short = build_fact_video(duration, data, self._transition_timing, scratch)
+
+                # render every overlay now so the encoder does not wait for ImageMagick
+                for element in short.get_pool():
+                    element.get_clip()
+            except Exception as e:
+                shutil.rmtree(scratch, ignore_errors=True)
+                results[i] = e
+                self.record('prepare', time.perf_counter() - start)
+                continue
+
+            # blocks while the encoder is `prefetch` shorts behind
+            prepared.put((i, data, short, scratch))
+            self.record('prepare', time.perf_counter() - start, prepared.qsize())
+
+        prepared.put(DONE)
+
+    def encode(self, prepared: queue.Queue, rendered: queue.Queue, results: list):
+        """
+        Method run by the encoding stage
+
+        :param prepared: queue of prepared shorts
+        :param rendered: queue feeding the packaging stage
+        :param results: list receiving output paths or errors
+        :return: None
+        """
+        while True:
+            item = prepared.get()
+
+            if item is DONE:
+                break
+
+            i, data, short, scratch = item
+            start = time.perf_counter()
+
+            try:
+                results[i] = short.render(fact_video_title(data), profile=self._profile,
+                                          threads=self._threads, scratch=scratch)
+            except Exception as e:
+                results[i] = e
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+            if isinstance(results[i], Exception):
+                self.record('encode', time.perf_counter() - start)
+                continue
+
+            rendered.put((i, data, results[i]))
+            self.record('encode', time.perf_counter() - start, rendered.qsize())
+
+        rendered.put(DONE)
+
+    def deliver(self, rendered: queue.Queue, results: list):
+        """
+        Method run by the packaging stage
+
+        :param rendered: queue of rendered shorts
+        :param results: list receiving errors
+        :return: None
+        """
+        while True:
+            item = rendered.get()
+
+            if item is DONE:
+                break
+
+            i, data, file_path = item
+            start = time.perf_counter()
+
+            if self._package is not None:
+                try:
+                    self._package(data, file_path)
+                except Exception as e:
+                    results[i] = e
+
+            self.record('package', time.perf_counter() - start)
+
+    def run(self, jobs: list):
+        """
+        Method to produce a list of shorts
+
+        :param jobs: list of (duration, data) tuples
+        :return: list in the same order as the jobs, holding the output path or the exception raised
+        """
+        self._stats = {}
+        results = [None] * len(jobs)
+
+        # bounded queues keep at most `prefetch` shorts in memory between stages
+        prepared = queue.Queue(maxsize=self._prefetch)
+        rendered = queue.Queue(maxsize=self._prefetch)
+
+        stages = [threading.Thread(target=self.prepare, args=(jobs, prepared, results)),
+                  threading.Thread(target=self.encode, args=(prepared, rendered, results)),
+                  threading.Thread(target=self.deliver, args=(rendered, results))]
+
+        for stage in stages:
+            stage.start()
+
+        for stage in stages:
+            stage.join()
+
+        return results
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+pool.py
+
+Store of every Pexels video which has already been used, shared between worker processes.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import functools
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+
+class VideoPool:
+    def __init__(self, database: str):
+        """
+        Constructor for the VideoPool class.
+
+        :param database: path of the SQLite database
+        :return: None
+        """
+        self._database = database
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('''CREATE TABLE IF NOT EXISTS pool (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  url TEXT NOT NULL UNIQUE,
+                                  added REAL NOT NULL
+                              )''')
+
+        # urls are loaded once and kept in a set for constant time lookups
+        self._urls = set()
+        self._last_id = 0
+
+        self.sync()
+
+    def connection(self):
+        """
+        Method to get the database connection of the current process
+
+        :return: sqlite3 Connection
+        """
+        # connections must not be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            # autocommit mode, every insert is its own transaction, and access is serialized by the lock
+            self._connection = sqlite3.connect(self._database, timeout=30, isolation_level=None,
+                                               check_same_thread=False)
+            self._pid = os.getpid()
+
+            # a lock held while forking would never be released in the child
+            self._lock = threading.Lock()
+
+        return self._connection
+
+    def sync(self):
+        """
+        Method to load urls added by other processes since the last sync
+
+        :return: None
+        """
+        connection = self.connection()
+
+        with self._lock:
+            for row_id, url in connection.execute('SELECT id, url FROM pool WHERE id > ? ORDER BY id',
+                                                  (self._last_id,)).fetchall():
+                self._urls.add(url)
+                self._last_id = row_id
+
+    def __contains__(self, url: str):
+        """
+        Method to check whether a url is in the pool
+
+        :param url: url to be checked
+        :return: True if the url has been used
+        """
+        return url in self._urls
+
+    def __len__(self):
+        """
+        Method to get the number of urls in the pool
+
+        :return: number of urls
+        """
+        return len(self._urls)
+
+    def add(self, url: str):
+        """
+        Method to add a url to the pool
+
+        :param url: url to be added
+        :return: True if the url was new, False if it was already claimed, possibly by another process
+        """
+        connection = self.connection()
+
+        with self._lock:
+            cursor = connection.execute('INSERT OR IGNORE INTO pool (url, added) VALUES (?, ?)', (url, time.time()))
+            self._urls.add(url)
+
+        return cursor.rowcount == 1
+
+    def extend(self, urls: list):
+        """
+        Method to add many urls to the pool in a single transaction
+
+        :param urls: urls to be added
+        :return: None
+        """
+        now = time.time()
+        connection = self.connection()
+
+        with self._lock:
+            connection.execute('BEGIN')
+            connection.executemany('INSERT OR IGNORE INTO pool (url, added) VALUES (?, ?)',
+                                   [(url, now) for url in urls])
+            connection.execute('COMMIT')
+
+            self._urls.update(urls)
+
+    def import_file(self, path: str):
+        """
+        Method to import a plain text pool file with one url per line
+
+        :param path: path of the pool file
+        :return: None
+        """
+        with open(path, 'r') as infile:
+            self.extend([line.strip() for line in infile if line.strip()])
+
+    def compact(self):
+        """
+        Method to fold the write-ahead log into the database and reclaim unused space
+
+        :return: None
+        """
+        connection = self.connection()
+
+        with self._lock:
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            connection.execute('VACUUM')
+
+
+@functools.lru_cache(maxsize=None)
+def get_pool(path: str):
+    """
+    Gets the shared video pool, importing the legacy plain text pool file on first use.
+
+    :param path: Path of the legacy pool file, the database is stored next to it
+    :return: VideoPool
+    """
+
+    database = path + '.db'
+    migrate = not os.path.exists(database) and os.path.exists(path)
+
+    pool = VideoPool(database)
+
+    if migrate:
+        pool.import_file(path)
+
+    return pool
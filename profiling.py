@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+profiling.py
+
+Opt-in instrumentation of the render stages. Nothing is measured unless a hook is registered.
+"""
+
+import time
+import resource
+import threading
+import contextlib
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# callbacks receiving (stage name, measurements) whenever a stage finishes
+hooks = []
+
+
+def add_hook(callback):
+    """
+    Registers a callback which is called with (stage name, measurements) after every stage.
+
+    :param callback: Function to be called
+    :return: None
+    """
+
+    hooks.append(callback)
+
+
+def remove_hook(callback):
+    """
+    Unregisters a callback.
+
+    :param callback: Function to be removed
+    :return: None
+    """
+
+    hooks.remove(callback)
+
+
+def peak_rss():
+    """
+    Gets the peak resident set size of this process and of its finished child processes, such as ffmpeg.
+
+    :return: Tuple of (own, children) peak RSS in kilobytes
+    """
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Measures a stage of the render when hooks are registered.
+
+    The body may set 'frames' in the yielded dictionary to report the number of frames it produced.
+
+    :param name: Name of the stage
+    :return: Dictionary for extra measurements
+    """
+
+    info = {}
+
+    if not hooks:
+        yield info
+        return
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    try:
+        yield info
+    finally:
+        info['wall'] = time.perf_counter() - wall
+        info['cpu'] = time.process_time() - cpu
+
+        report(name, info)
+
+
+def report(name: str, info: dict):
+    """
+    Passes measurements taken by the caller to the hooks, for stages which are not a single block of code.
+
+    :param name: Name of the stage
+    :param info: Measurements including 'wall' and 'cpu'
+    :return: None
+    """
+
+    if not hooks:
+        return
+
+    info['peak_rss_kb'], info['children_peak_rss_kb'] = peak_rss()
+
+    if 'frames' in info and info['wall'] > 0:
+        info['fps'] = info['frames'] / info['wall']
+
+    for callback in list(hooks):
+        callback(name, info)
+
+
+class Recorder:
+    def __init__(self):
+        """
+        Constructor for the Recorder class, a hook which aggregates measurements per stage.
+
+        :return: None
+        """
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, info: dict):
+        """
+        Method called by stage() with the measurements of a finished stage
+
+        :param name: name of the stage
+        :param info: measurements
+        :return: None
+        """
+        with self._lock:
+            stats = self._stages.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'frames': 0,
+                                                   'peak_rss_kb': 0, 'children_peak_rss_kb': 0})
+            stats['count'] += 1
+            stats['wall'] += info['wall']
+            stats['cpu'] += info['cpu']
+            stats['frames'] += info.get('frames', 0)
+            stats['peak_rss_kb'] = max(stats['peak_rss_kb'], info['peak_rss_kb'])
+            stats['children_peak_rss_kb'] = max(stats['children_peak_rss_kb'], info['children_peak_rss_kb'])
+
+    def get_stages(self):
+        """
+        Method to get the aggregated measurements
+
+        :return: dictionary of stage name to measurements
+        """
+        with self._lock:
+            stages = {}
+
+            for name, stats in self._stages.items():
+                stages[name] = dict(stats)
+
+                if stats['frames'] and stats['wall'] > 0:
+                    stages[name]['fps'] = stats['frames'] / stats['wall']
+
+            return stages
+
+    def reset(self):
+        """
+        Method to clear the aggregated measurements
+
+        :return: None
+        """
+        with self._lock:
+            self._stages = {}
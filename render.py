@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+
+"""
+render.py
+
+Encodes clips by streaming raw frames into a single long-lived ffmpeg process.
+"""
+
+import os
+import time
+import weakref
+import tempfile
+import threading
+import contextlib
+import subprocess
+import numpy as np
+from profiling import hooks, stage, report
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# sample rate of the audio handed to the encoder
+AUDIO_FPS = 44100
+
+# float32 samples at AUDIO_FPS of audio clips which play them unchanged, so they can be piped without decoding
+PLAIN_AUDIO = weakref.WeakKeyDictionary()
+
+
+class RenderProfile:
+    def __init__(self, codec: str = 'libx264', preset: str = 'medium', crf: int = 20, bitrate: str = None,
+                 threads: int = None, fps: int = 30, gop: int = 60, faststart: bool = True,
+                 pixel_format: str = 'yuv420p', audio_codec: str = 'aac', audio_bitrate: str = '192k'):
+        """
+        Constructor for the RenderProfile class.
+
+        :param codec: ffmpeg video encoder
+        :param preset: encoder preset
+        :param crf: constant rate factor, used when no bitrate is given
+        :param bitrate: target video bitrate such as '8M'
+        :param threads: number of encoder threads, None lets ffmpeg decide
+        :param fps: output frame rate
+        :param gop: maximum number of frames between keyframes
+        :param faststart: move the index to the front of the file for progressive playback
+        :param pixel_format: output pixel format
+        :param audio_codec: ffmpeg audio encoder
+        :param audio_bitrate: audio bitrate
+        :return: None
+        """
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.bitrate = bitrate
+        self.threads = threads
+        self.fps = fps
+        self.gop = gop
+        self.faststart = faststart
+        self.pixel_format = pixel_format
+        self.audio_codec = audio_codec
+        self.audio_bitrate = audio_bitrate
+
+    def copy(self, **changes):
+        """
+        Method to create a copy of the profile with some settings changed
+
+        :param changes: settings to be changed
+        :return: new RenderProfile
+        """
+        settings = dict(self.__dict__)
+        settings.update(changes)
+
+        return RenderProfile(**settings)
+
+    def output_args(self):
+        """
+        Method to build the ffmpeg output arguments for the profile
+
+        :return: list of ffmpeg arguments
+        """
+        args = ['-c:v', self.codec,
+                '-preset', self.preset,
+                '-pix_fmt', self.pixel_format,
+                '-r', str(self.fps)]
+
+        if self.bitrate is not None:
+            args += ['-b:v', self.bitrate]
+        else:
+            args += ['-crf', str(self.crf)]
+
+        if self.threads is not None:
+            args += ['-threads', str(self.threads)]
+
+        if self.gop is not None:
+            args += ['-g', str(self.gop)]
+
+        if self.faststart:
+            args += ['-movflags', '+faststart']
+
+        args += ['-c:a', self.audio_codec,
+                 '-b:a', self.audio_bitrate]
+
+        return args
+
+
+# built-in profiles for quick QA previews and final uploads
+PROFILES = {
+    'draft': RenderProfile(preset='ultrafast', crf=30, fps=24, gop=48, audio_bitrate='96k'),
+    'publish': RenderProfile(preset='medium', crf=18, fps=30, gop=60, audio_bitrate='192k')
+}
+
+
+class OutputTarget:
+    def __init__(self, name: str, size: tuple = None, crop='fill', bitrate: str = None, container: str = 'mp4',
+                 filename: str = None, **changes):
+        """
+        Constructor for the OutputTarget class, one of several files encoded from the same frames.
+
+        :param name: name of the target, such as the platform
+        :param size: output resolution as (width, height), None keeps the composition's
+        :param crop: 'fill' to crop to the output aspect ratio, 'fit' to letterbox, or a region as (x, y, width,
+                     height) of the composition
+        :param bitrate: target video bitrate such as '8M', None uses the profile's
+        :param container: container format, also the file extension
+        :param filename: output filename with a {title} placeholder, defaults to '{title}.<name>.<container>'
+        :param changes: other RenderProfile settings to be changed for this target, such as codec
+        :return: None
+        """
+        self.name = name
+        self.size = size
+        self.crop = crop
+        self.bitrate = bitrate
+        self.container = container
+        self.filename = filename if filename is not None else '{title}.' + name + '.' + container
+        self.changes = changes
+
+    def get_muxer(self):
+        """
+        Method to get the ffmpeg muxer of the target's container
+
+        :return: muxer name
+        """
+        return {'mkv': 'matroska', 'm4v': 'mp4'}.get(self.container, self.container)
+
+    def get_filename(self, title: str):
+        """
+        Method to get the filename of a rendered video
+
+        :param title: title of the video
+        :return: filename
+        """
+        return self.filename.format(title=title)
+
+    def get_profile(self, profile: RenderProfile):
+        """
+        Method to apply the target's settings to a profile
+
+        :param profile: base encoder settings
+        :return: RenderProfile for this target
+        """
+        changes = dict(self.changes)
+
+        if self.bitrate is not None:
+            changes['bitrate'] = self.bitrate
+
+        # only the ISO containers have an index which can be moved
+        if self.container not in ('mp4', 'mov'):
+            changes.setdefault('faststart', False)
+
+        return profile.copy(**changes) if changes else profile
+
+    def video_filter(self, width: int, height: int):
+        """
+        Method to build the ffmpeg filter which turns the composition into this target's frames
+
+        :param width: width of the composition
+        :param height: height of the composition
+        :return: filter string, None if the frames are used as they are
+        """
+        if self.size is None and self.crop in ('fill', 'fit'):
+            return None
+
+        out_width, out_height = self.size if self.size is not None else (width, height)
+
+        if isinstance(self.crop, (tuple, list)):
+            x, y, crop_width, crop_height = self.crop
+            return f'crop={crop_width}:{crop_height}:{x}:{y},scale={out_width}:{out_height},setsar=1'
+
+        if self.crop == 'fit':
+            # scale to fit inside the output and pad the rest
+            scale = min(out_width / width, out_height / height)
+            fit_width, fit_height = 2 * round(width * scale / 2), 2 * round(height * scale / 2)
+
+            return (f'scale={fit_width}:{fit_height},pad={out_width}:{out_height}:{(out_width - fit_width) // 2}:'
+                    f'{(out_height - fit_height) // 2},setsar=1')
+
+        if self.crop != 'fill':
+            raise ValueError(f'Unknown crop mode: "{self.crop}"')
+
+        # largest centered region with the output aspect ratio
+        crop_width = min(width, round(height * out_width / out_height))
+        crop_height = min(height, round(width * out_height / out_width))
+
+        return (f'crop={crop_width}:{crop_height}:{(width - crop_width) // 2}:{(height - crop_height) // 2},'
+                f'scale={out_width}:{out_height},setsar=1')
+
+
+# built-in targets for the platforms shorts are published to
+TARGETS = {
+    'shorts': OutputTarget('shorts', size=(1080, 1920), filename='{title}.mp4'),
+    'tiktok': OutputTarget('tiktok', size=(1080, 1920), bitrate='6M'),
+    'square': OutputTarget('square', size=(1080, 1080)),
+    'preview': OutputTarget('preview', size=(540, 960), container='webm', codec='libvpx-vp9', preset='good',
+                            audio_codec='libopus', audio_bitrate='96k')
+}
+
+
+def get_target(target):
+    """
+    Resolves an output target given by name or as an OutputTarget.
+
+    :param target: Name of a built-in target or an OutputTarget
+    :return: OutputTarget
+    """
+
+    if isinstance(target, OutputTarget):
+        return target
+
+    if target not in TARGETS:
+        raise ValueError(f'Unknown output target: "{target}"')
+
+    return TARGETS[target]
+
+
+def get_profile(profile):
+    """
+    Resolves a profile given by name or as a RenderProfile.
+
+    :param profile: Name of a built-in profile or a RenderProfile
+    :return: RenderProfile
+    """
+
+    if isinstance(profile, RenderProfile):
+        return profile
+
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown render profile: "{profile}"')
+
+    return PROFILES[profile]
+
+
+def audio_samples(audio, fps: int = AUDIO_FPS):
+    """
+    Gets the samples of an audio clip as float32, without a copy for clips registered in PLAIN_AUDIO.
+
+    :param audio: Audio clip
+    :param fps: Sample rate
+    :return: Array of shape (samples, channels)
+    """
+
+    samples = PLAIN_AUDIO.get(audio) if fps == AUDIO_FPS else None
+
+    if samples is None:
+        samples = audio.to_soundarray(fps=fps)
+
+    samples = np.ascontiguousarray(samples, dtype='<f4')
+
+    if samples.ndim == 1:
+        samples = samples[:, None]
+
+    return samples
+
+
+def write_samples(fd: int, samples: np.ndarray):
+    """
+    Writes samples into a pipe, stopping quietly if the reader goes away.
+
+    :param fd: File descriptor of the write end of the pipe
+    :param samples: Contiguous float32 samples
+    :return: None
+    """
+
+    try:
+        with open(fd, 'wb') as pipe:
+            pipe.write(memoryview(samples).cast('B'))
+    except BrokenPipeError:
+        pass
+
+
+@contextlib.contextmanager
+def audio_pipe(audio, fps: int = AUDIO_FPS):
+    """
+    Streams the raw float32 samples of an audio clip to ffmpeg through a pipe, written by a background thread.
+
+    :param audio: Audio clip
+    :param fps: Sample rate
+    :return: Context manager giving (ffmpeg input arguments, file descriptor to pass to ffmpeg)
+    """
+
+    with stage('audio'):
+        samples = audio_samples(audio, fps)
+
+    read_fd, write_fd = os.pipe()
+
+    writer = threading.Thread(target=write_samples, args=(write_fd, samples), daemon=True)
+    writer.start()
+
+    try:
+        yield ['-f', 'f32le', '-ar', str(fps), '-ac', str(samples.shape[1]), '-i', f'pipe:{read_fd}'], read_fd
+    finally:
+        # without a reader left the writer stops, even if ffmpeg did not read every sample
+        os.close(read_fd)
+        writer.join()
+
+
+def split_outputs(source: str, outputs: list):
+    """
+    Builds the filtergraph which splits one video stream between several outputs, each with its own filter.
+
+    :param source: Label of the video stream, such as '[0:v]'
+    :param outputs: List of (path, RenderProfile, video filter or None, container or None) per output file
+    :return: Tuple of (list of filtergraph chains, list of output stream labels)
+    """
+
+    if len(outputs) == 1:
+        video_filter = outputs[0][2] if outputs[0][2] is not None else 'null'
+        return [f'{source}{video_filter}[v0]'], ['[v0]']
+
+    # split the frames once and give every output its own crop and scale
+    labels = [f'[s{i}]' for i in range(len(outputs))]
+    graph = [f'{source}split={len(outputs)}' + ''.join(labels)]
+    streams = []
+
+    for i, (_, _, video_filter, _) in enumerate(outputs):
+        graph.append(f'{labels[i]}{video_filter if video_filter is not None else "null"}[v{i}]')
+        streams.append(f'[v{i}]')
+
+    return graph, streams
+
+
+def output_args(outputs: list, streams: list, audio_streams: list):
+    """
+    Builds the ffmpeg arguments of several output files.
+
+    :param outputs: List of (path, RenderProfile, video filter or None, container or None) per output file
+    :param streams: Video stream of every output
+    :param audio_streams: Audio stream of every output, None for a silent output
+    :return: List of ffmpeg arguments
+    """
+
+    args = []
+
+    for stream, audio_stream, (path, profile, _, container) in zip(streams, audio_streams, outputs):
+        args += ['-map', stream]
+
+        if audio_stream is not None:
+            args += ['-map', audio_stream, '-shortest']
+
+        args += profile.output_args()
+
+        if container is not None:
+            args += ['-f', container]
+
+        args.append(path)
+
+    return args
+
+
+def encode(video, audio, filename: str, profile: RenderProfile, scratch: str = None):
+    """
+    Encodes a video clip and an audio clip into a file with one ffmpeg process fed through its stdin.
+
+    :param video: Video clip
+    :param audio: Audio clip
+    :param filename: Path of the output file
+    :param profile: Encoder settings
+    :param scratch: Directory for intermediate files, unused as the audio is piped
+    :return: None
+    """
+
+    encode_outputs(video, audio, [(filename, profile, None, None)], profile.fps, scratch)
+
+
+def encode_outputs(video, audio, outputs: list, fps: int, scratch: str = None):
+    """
+    Encodes a video clip and an audio clip into several files at once. The frames are composited once and piped
+    into a single ffmpeg process, which splits them between the outputs and encodes them in parallel.
+
+    :param video: Video clip
+    :param audio: Audio clip
+    :param outputs: List of (path, RenderProfile, video filter or None, container or None) per output file
+    :param fps: Frame rate of the piped frames
+    :param scratch: Directory for intermediate files, unused as the audio is piped
+    :return: None
+    """
+
+    width, height = video.size
+    frame_count = int(round(video.duration * fps))
+    filename = ', '.join(path for path, _, _, _ in outputs)
+
+    # frames go through stdin, the float32 audio samples through a second pipe
+    with audio_pipe(audio) as (audio_args, audio_fd):
+        command = ['ffmpeg',
+                   '-y',
+                   '-v', 'error',
+                   '-f', 'rawvideo',
+                   '-pix_fmt', 'rgb24',
+                   '-s', f'{width}x{height}',
+                   '-r', str(fps),
+                   '-i', '-'] + audio_args
+
+        if len(outputs) == 1 and outputs[0][2] is None:
+            command += output_args(outputs, ['0:v'], ['1:a'])
+        else:
+            graph, streams = split_outputs('[0:v]', outputs)
+            command += ['-filter_complex', ';'.join(graph)] + output_args(outputs, streams, ['1:a'] * len(outputs))
+
+        # stderr goes to a file so a chatty encoder can never block on a full pipe
+        with tempfile.TemporaryFile() as log, stage('encode') as info:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=log, pass_fds=(audio_fd,))
+
+            # one buffer is reused for every frame
+            buffer = np.empty((height, width, 3), dtype='uint8')
+
+            # time spent producing frames, reported separately from the encode as a whole
+            composite = {'wall': 0.0, 'cpu': 0.0, 'frames': 0}
+            timed = bool(hooks)
+
+            try:
+                for i in range(frame_count):
+                    if timed:
+                        wall, cpu = time.perf_counter(), time.process_time()
+
+                    np.copyto(buffer, video.get_frame(i / fps), casting='unsafe')
+
+                    if timed:
+                        composite['wall'] += time.perf_counter() - wall
+                        composite['cpu'] += time.process_time() - cpu
+                        composite['frames'] += 1
+
+                    process.stdin.write(memoryview(buffer))
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()
+                process.wait()
+
+            info['frames'] = frame_count
+
+            if timed:
+                report('composite', composite)
+
+            if process.returncode != 0:
+                log.seek(0)
+                raise IOError(f'ffmpeg failed to encode "{filename}": {log.read().decode(errors="replace").strip()}')
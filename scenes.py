@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+scenes.py
+
+Offline shot analysis of background videos, so segments which straddle a cut, fade to black or barely move can be
+avoided at selection time without decoding anything.
+"""
+
+import os
+import math
+import random
+import subprocess
+import numpy as np
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# sampling of the analysis, frames per second and size of the grayscale thumbnails
+ANALYSIS_FPS = 4
+ANALYSIS_SIZE = 32
+
+# mean absolute difference between neighbouring samples above which a hard cut is assumed
+CUT_THRESHOLD = float(os.getenv('CUT_THRESHOLD', 0.15))
+
+# quality thresholds every second of a selected segment has to pass, as fractions of full scale
+MIN_BRIGHTNESS = float(os.getenv('MIN_BRIGHTNESS', 0.08))
+MIN_MOTION = float(os.getenv('MIN_MOTION', 0.002))
+MAX_MOTION = float(os.getenv('MAX_MOTION', 0.12))
+
+
+def read_thumbnails(path: str, fps: int = ANALYSIS_FPS, size: int = ANALYSIS_SIZE):
+    """
+    Decodes a video into small grayscale thumbnails at a low frame rate.
+
+    :param path: Path of the video
+    :param fps: Thumbnails per second
+    :param size: Width and height of the thumbnails
+    :return: Array of shape (samples, size, size) with values between 0 and 1
+    """
+
+    command = ['ffmpeg',
+               '-v', 'error',
+               '-i', path,
+               '-an',
+               '-vf', f'fps={fps},scale={size}:{size},format=gray',
+               '-f', 'rawvideo',
+               '-']
+
+    result = subprocess.run(command, capture_output=True)
+
+    if result.returncode != 0:
+        raise IOError(f'ffmpeg failed to analyze "{path}": {result.stderr.decode(errors="replace").strip()}')
+
+    frames = np.frombuffer(result.stdout, dtype='uint8')
+    frames = frames[:len(frames) - len(frames) % (size * size)]
+
+    return frames.reshape(-1, size, size).astype('float32') / 255
+
+
+def analyze_scenes(path: str, fps: int = ANALYSIS_FPS):
+    """
+    Computes the shot boundaries and per-second brightness and motion of a video.
+
+    :param path: Path of the video
+    :param fps: Samples per second
+    :return: Dictionary of 'cuts' (seconds), 'brightness' (darkest sample per second) and 'motion' (mean change
+             between samples per second, cuts excluded)
+    """
+
+    frames = read_thumbnails(path, fps)
+
+    if len(frames) == 0:
+        raise IOError(f'No frames could be decoded from "{path}"')
+
+    seconds = math.ceil(len(frames) / fps)
+    padding = seconds * fps - len(frames)
+
+    brightness = frames.mean(axis=(1, 2))
+
+    # change between every sample and the one before it, the first sample has none
+    difference = np.zeros(len(frames), dtype='float32')
+    difference[1:] = np.abs(frames[1:] - frames[:-1]).mean(axis=(1, 2))
+
+    # a cut is a change well above the usual motion of the video
+    cuts = (difference > CUT_THRESHOLD) & (difference > 4 * np.median(difference))
+
+    # motion only counts changes within a shot
+    moving = ~cuts
+    moving[0] = False
+
+    # reduce every second, padding the last one
+    brightness = np.pad(brightness, (0, padding), mode='edge').reshape(seconds, fps).min(axis=1)
+    total = np.pad(np.where(moving, difference, 0), (0, padding)).reshape(seconds, fps).sum(axis=1)
+    count = np.pad(moving, (0, padding)).reshape(seconds, fps).sum(axis=1)
+    motion = total / np.maximum(count, 1)
+
+    return {'cuts': (np.flatnonzero(cuts) / fps).round(3).tolist(),
+            'brightness': brightness.round(4).tolist(),
+            'motion': motion.round(4).tolist()}
+
+
+def usable_starts(scenes: dict, duration: float, length: float):
+    """
+    Finds every whole-second start of a segment which stays inside one shot and passes the quality thresholds.
+
+    :param scenes: Analysis of the video as returned by analyze_scenes
+    :param duration: Duration of the segment
+    :param length: Duration of the video
+    :return: Array of start seconds
+    """
+
+    brightness = np.asarray(scenes['brightness'], dtype='float32')
+    motion = np.asarray(scenes['motion'], dtype='float32')
+
+    bad = (brightness < MIN_BRIGHTNESS) | (motion < MIN_MOTION) | (motion > MAX_MOTION)
+
+    # a cut between two seconds rules out every segment covering the second it ends in
+    cuts = np.ceil(np.asarray(scenes['cuts'], dtype='float32')).astype(int) - 1
+    bad[cuts[(cuts >= 0) & (cuts < len(bad))]] = True
+
+    window = math.ceil(duration)
+
+    if window > len(bad):
+        return np.zeros(0, dtype=int)
+
+    # number of bad seconds in every window
+    bad_count = np.convolve(bad, np.ones(window, dtype=int), mode='valid')
+    starts = np.flatnonzero(bad_count == 0)
+
+    return starts[starts + duration <= length]
+
+
+def pick_start(entry: dict, duration: float):
+    """
+    Picks a random start of a segment which stays inside one shot and passes the quality thresholds.
+
+    :param entry: Media index entry of the video, with its 'scenes' analysis
+    :param duration: Duration of the segment
+    :return: Start second, or None if the video has no usable segment
+    """
+
+    if entry.get('scenes') is None:
+        # not analyzed, fall back to any whole-second start
+        return float(random.randint(0, int(entry['duration'] - duration)))
+
+    starts = usable_starts(entry['scenes'], duration, entry['duration'])
+
+    if len(starts) == 0:
+        return None
+
+    return float(random.choice(starts))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+timing.py
+
+Caption timing based on reading speed. Everything here is pure arithmetic on the caption texts, so the duration of
+a short is known before any media is selected.
+"""
+
+import os
+import math
+
+__author__ = "Caleb Smith"
+__credits__ = ["Caleb Smith"]
+__version__ = "1.0"
+__maintainer__ = "Caleb Smith"
+__email__ = "me@calebmsmith.com"
+__status__ = "Development"
+
+# reading speed, whichever of the word and character rates takes longer applies
+WORDS_PER_MINUTE = float(os.getenv('WORDS_PER_MINUTE', 180))
+CHARS_PER_SECOND = float(os.getenv('CHARS_PER_SECOND', 15))
+
+# time to notice a new caption before reading starts, and the limits of a caption's time on screen
+REACTION_TIME = 0.6
+MIN_CAPTION = float(os.getenv('MIN_CAPTION', 2.0))
+MAX_CAPTION = float(os.getenv('MAX_CAPTION', 8.0))
+
+
+def reading_time(text: str, words_per_minute: float = WORDS_PER_MINUTE, chars_per_second: float = CHARS_PER_SECOND,
+                 minimum: float = MIN_CAPTION, maximum: float = MAX_CAPTION):
+    """
+    Computes how long a caption should stay on screen.
+
+    :param text: Text of the caption
+    :param words_per_minute: Reading speed in words
+    :param chars_per_second: Reading speed in characters, excluding spaces
+    :param minimum: Shortest time on screen
+    :param maximum: Longest time on screen
+    :return: Seconds, rounded up to a tenth
+    """
+
+    words = len(text.split())
+    chars = len(''.join(text.split()))
+
+    seconds = REACTION_TIME + max(words * 60 / words_per_minute, chars / chars_per_second)
+
+    # round up so the duration is stable and never shorter than the reading time
+    return min(max(math.ceil(round(seconds * 10, 6)) / 10, minimum), maximum)
+
+
+def caption_durations(captions: list, **speed):
+    """
+    Computes the time on screen of every caption.
+
+    :param captions: Texts of the captions
+    :param speed: Optional reading_time() settings
+    :return: List of seconds per caption
+    """
+
+    return [reading_time(text, **speed) for text in captions]
+
+
+def short_duration(captions: list, transition_timing: float = 0.5, maximum: float = None, **speed):
+    """
+    Computes the duration of a short showing every caption for its reading time.
+
+    :param captions: Texts of the captions
+    :param transition_timing: Transition timing between captions
+    :param maximum: Longest duration, caption_slots() shrinks the reading times to fit
+    :param speed: Optional reading_time() settings
+    :return: Duration in seconds
+    """
+
+    durations = caption_durations(captions, **speed)
+    transitions = transition_timing * (len(durations) - 1)
+    duration = round(sum(durations) + transitions, 6)
+
+    if maximum is not None and duration > maximum:
+        # shrinking must still leave every caption its minimum time on screen
+        shortest = round(speed.get('minimum', MIN_CAPTION) * len(durations) + transitions, 6)
+
+        if shortest > maximum:
+            raise ValueError(f'{len(durations)} captions need at least {shortest}s, more than the maximum duration '
+                             f'of {maximum}s')
+
+        duration = maximum
+
+    return duration
+
+
+def caption_slots(captions: list, duration: float, transition_timing: float, **speed):
+    """
+    Lays out captions over a short, giving each a share of the time proportional to its reading time.
+
+    When the duration comes from short_duration() every caption gets exactly its reading time.
+
+    :param captions: Texts of the captions
+    :param duration: Duration of the short
+    :param transition_timing: Transition timing between captions
+    :param speed: Optional reading_time() settings
+    :return: Tuple of (start, duration) per caption
+    """
+
+    durations = caption_durations(captions, **speed)
+
+    if not durations:
+        return ()
+
+    available = duration - transition_timing * (len(durations) - 1)
+
+    if available <= 0:
+        raise ValueError(f'A duration of {duration}s leaves no time for {len(durations)} captions')
+
+    # stretch or shrink the reading times to the time available for captions
+    scale = available / sum(durations)
+
+    slots = []
+    start = 0.0
+
+    for i, length in enumerate(durations):
+        if i == len(durations) - 1:
+            # last caption covers the remaining duration
+            length = duration - start
+        else:
+            length = round(length * scale, 6)
+
+        slots.append((start, length))
+        start = round(start + length + transition_timing, 6)
+
+    return tuple(slots)
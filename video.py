@@ -2,11 +2,22 @@
 
 """ video.py """
 
+import time
+import atexit
+import weakref
 import requests
-import random
-from pexelsPy import API
+import functools
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from moviepy.editor import *
+from media import get_media_index, probe, scratch_file, extract_segment
+from scenes import analyze_scenes, pick_start
+from pool import get_pool
+from profiling import stage
+from glyphs import get_atlas
 from PIL import Image, ImageDraw
 
 __author__ = "Caleb Smith"
@@ -22,14 +33,36 @@ load_dotenv()
 # retrieve the Pexels API key from environment variables
 PEXELS_API = os.getenv('PEXELS_API')
 
+# Pexels endpoints, overridable to point the fetcher at another server
+PEXELS_API_URL = os.getenv('PEXELS_API_URL', 'https://api.pexels.com')
+PEXELS_DOWNLOAD_URL = os.getenv('PEXELS_DOWNLOAD_URL', 'https://www.pexels.com/video/{id}/download')
 
-def round_corners(image: Image, rad: int):
+# fetcher settings
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 4))
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', 3600))
+CHUNK_SIZE = 1024 * 1024
+
+# directory of pre-normalized archive videos and their format
+PROXY_ARCHIVE = os.getenv('PROXY_ARCHIVE', 'proxy_archive')
+PROXY_SIZE = (1080, 1920)
+PROXY_FPS = 30
+
+# clips returned by random_video_clip, whose file ffmpeg can read in place of the clip
+PLAIN_CLIPS = weakref.WeakSet()
+
+# text rendering backends, see generate_text
+TEXT_BACKENDS = ('imagemagick', 'atlas')
+TEXT_BACKEND = os.getenv('TEXT_BACKEND', 'imagemagick')
+
+
+@functools.lru_cache(maxsize=64)
+def corner_mask(size: tuple, rad: int):
     """
-    Rounds the corners of a given image based on a given radius.
+    Builds the alpha mask used to round the corners of an image of a given size.
 
-    :param image: Image to be processed
+    :param size: Size of the image as (width, height)
     :param rad: Radius of the corners
-    :return: Processed image
+    :return: Read-only alpha mask array with values 0 or 255
     """
 
     # create a circular mask
@@ -38,9 +71,9 @@ def round_corners(image: Image, rad: int):
     draw.ellipse((0, 0, rad * 2 - 1, rad * 2 - 1), fill=255)
 
     # create an alpha mask
-    alpha = Image.new('L', image.size, 255)
+    alpha = Image.new('L', size, 255)
 
-    w, h = image.size
+    w, h = size
 
     # paste the circular mask to the corners of the alpha mask
     alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
@@ -48,15 +81,54 @@ def round_corners(image: Image, rad: int):
     alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
     alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
 
+    # the array is shared between callers so it must not be modified
+    mask = np.asarray(alpha)
+    mask.setflags(write=False)
+
+    return mask
+
+
+def round_corners(image: Image, rad: int):
+    """
+    Rounds the corners of a given image based on a given radius.
+
+    :param image: Image to be processed
+    :param rad: Radius of the corners
+    :return: Processed image
+    """
+
     # apply the alpha mask to the image
-    image.putalpha(alpha)
+    image.putalpha(Image.fromarray(corner_mask(image.size, rad)))
 
     return image
 
 
+def rounded_background(size: tuple, color: tuple, opacity: float, rad: int):
+    """
+    Builds a rounded rectangle background directly as an RGBA array.
+
+    :param size: Size of the rectangle as (width, height)
+    :param color: RGB color of the rectangle
+    :param opacity: Opacity of the rectangle
+    :param rad: Radius of the corners
+    :return: RGBA array of the rectangle
+    """
+
+    w, h = size
+
+    # match the color produced by compositing the semi-transparent rectangle onto black
+    rgb = (1.0 * opacity * np.array(color, dtype=float)).astype('uint8')
+
+    rgba = np.empty((h, w, 4), dtype='uint8')
+    rgba[:, :, :3] = rgb
+    rgba[:, :, 3] = corner_mask((w, h), rad)
+
+    return rgba
+
+
 def generate_text(text='{Text Clip}', text_type='label', text_color='white', font='Lato-Bold', box_size=(None, None),
                   font_size=50, bg_opacity=1, bg_padding=(60, 40), bg_color=(0, 0, 0), radius=30, stroke_color=None,
-                  stroke_width=0, position=('center', 'center'), start=0, duration=5.0):
+                  stroke_width=0, position=('center', 'center'), start=0, duration=5.0, text_backend='imagemagick'):
     """
     Generates a text clip to be inserted into a video.
 
@@ -75,28 +147,29 @@ def generate_text(text='{Text Clip}', text_type='label', text_color='white', fon
     :param position: Position of the text
     :param start: Start second of the text
     :param duration: Duration of the text in the video
+    :param text_backend: 'imagemagick' for MoviePy's TextClip or 'atlas' for cached Pillow glyphs
     :return: Final text clip
     """
 
     # create a base text clip
-    text_clip = TextClip(txt=text, size=box_size, font=font, stroke_color=stroke_color, stroke_width=stroke_width,
-                         color=text_color, method=text_type, fontsize=font_size).set_position('center')
+    with stage('text'):
+        if text_backend == 'atlas':
+            text_clip = ImageClip(get_atlas(font, font_size, stroke_width).render(text, text_color, stroke_color,
+                                                                                  box_size),
+                                  transparent=True).set_position('center')
+        else:
+            text_clip = TextClip(txt=text, size=box_size, font=font, stroke_color=stroke_color,
+                                 stroke_width=stroke_width, color=text_color, method=text_type,
+                                 fontsize=font_size).set_position('center')
 
     # create the color clip rectangle
     color_clip = ColorClip(size=(text_clip.size[0] + bg_padding[0], text_clip.size[1] + bg_padding[1]), color=bg_color).set_opacity(bg_opacity)
 
     if bg_opacity > 0 and radius > 0:
-        # save the clip as an image to be rounded
-        CompositeVideoClip([color_clip]).save_frame('temp.png')
-
-        # round the corners of the rectangle
-        round_corners(Image.open('temp.png'), radius).save('temp.png')
-
-        # open the final version of the rectangle into an image clip
-        color_clip = ImageClip('temp.png').set_opacity(bg_opacity)
-
-        # delete the temporary image
-        os.remove('temp.png')
+        # build the rounded rectangle in memory
+        with stage('round_corners'):
+            color_clip = ImageClip(rounded_background(color_clip.size, bg_color, bg_opacity, radius),
+                                   transparent=True).set_opacity(bg_opacity)
 
     # overlay the text on top of the background clip
     final_clip = CompositeVideoClip([color_clip, text_clip])
@@ -107,85 +180,300 @@ def generate_text(text='{Text Clip}', text_type='label', text_color='white', fon
 
 def add_to_video_pool(video: str):
     """
-    Adds a video to the video pool file.
+    Adds a video to the video pool.
 
-    :param video: Video file path to be added
-    :return: None
+    :param video: Video url to be added
+    :return: True if the video was not in the pool yet
+    """
+
+    return get_video_pool().add(video)
+
+
+def get_video_pool():
     """
+    Retrieves the shared video pool, picking up videos added by other processes.
 
-    file = open(os.getenv('VIDEO_POOL'), 'a+')
+    :return: VideoPool supporting constant time membership checks
+    """
 
-    file.write(video + '\n')
+    pool = get_pool(os.getenv('VIDEO_POOL'))
+    pool.sync()
 
-    file.close()
+    return pool
 
 
-def get_video_pool():
+@functools.lru_cache(maxsize=None)
+def get_session():
     """
-    Reads the video pool file and retrieves a list of video paths.
+    Gets the shared HTTP session, which keeps connections to each host open between requests.
 
-    :return: List of video paths
+    :return: requests Session
     """
 
-    videos = open(os.getenv('VIDEO_POOL'), 'r').readlines()
+    session = requests.Session()
 
-    for i in range(len(videos)):
-        videos[i] = videos[i].replace('\n', '')
+    # allow one pooled connection per download worker
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-    return videos
+    return session
 
 
 def download_video(video_url: str, title: str):
     """
     Downloads a video from a given URL and saves it with the specified title.
 
+    The download is streamed to a temporary file in chunks and renamed once complete.
+
     :param video_url: URL of the video to be downloaded
     :param title: Title to be used for the saved video
     :return: None
     """
 
-    r = requests.get(video_url)
+    temp_path = title + '.part'
 
-    with open(title, 'wb') as outfile:
-        outfile.write(r.content)
+    try:
+        with get_session().get(video_url, stream=True, timeout=60) as r:
+            r.raise_for_status()
 
-    outfile.close()
+            with open(temp_path, 'wb') as outfile:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    outfile.write(chunk)
 
+        os.replace(temp_path, title)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-def fetch_video(topic):
+
+# search result pages by (topic, page), with the time they were fetched
+search_cache = {}
+
+# downloaded but unclaimed videos by topic, as (url, path), kept for the next short of this process
+spare_videos = {}
+
+
+@atexit.register
+def discard_spare_videos():
     """
-    Downloads a random vertical video from Pexels.
+    Deletes the downloaded videos which no short of this process has used.
 
-    :param topic: Topic of the video
-    :return: Path of the downloaded video
+    :return: None
+    """
+
+    for videos in spare_videos.values():
+        for _, path in videos:
+            if os.path.exists(path):
+                os.remove(path)
+
+    spare_videos.clear()
+
+
+def search_videos(topic: str, page: int):
+    """
+    Searches Pexels for videos on a topic, reusing recently fetched result pages.
+
+    :param topic: Topic of the videos
+    :param page: Result page number
+    :return: List of video dictionaries
+    """
+
+    cached = search_cache.get((topic, page))
+
+    if cached is not None and time.time() - cached[0] < SEARCH_CACHE_TTL:
+        return cached[1]
+
+    r = get_session().get(PEXELS_API_URL + '/videos/search',
+                          params={'query': topic, 'page': page, 'per_page': 10},
+                          headers={'Authorization': PEXELS_API},
+                          timeout=30)
+    r.raise_for_status()
+
+    videos = r.json().get('videos', [])
+    search_cache[(topic, page)] = (time.time(), videos)
+
+    return videos
+
+
+def fetch_videos(topic: str, count: int):
     """
+    Downloads several random vertical videos from Pexels concurrently.
+
+    The videos are not claimed in the video pool, callers claim only those they use or reject for good with
+    add_to_video_pool. Paths include the process id, so processes downloading the same video never share a file.
 
-    # load the Pexels API using the API key
-    api = API(PEXELS_API)
+    :param topic: Topic of the videos
+    :param count: Number of videos to download
+    :return: List of (url, path) of the downloaded videos
+    """
 
-    # retrieve all previously used videos
+    # retrieve all previously used videos, and those already downloaded by this process
     video_pool = get_video_pool()
+    spare = {url for videos in spare_videos.values() for url, _ in videos}
+
+    candidates = []
 
     # set the initial page number
     page_num = 1
 
-    # search for a new Pexels video
-    while True:
-        api.search_videos(topic, page=page_num, results_per_page=10)
-        videos = api.get_videos()
+    # search for new Pexels videos
+    while len(candidates) < count:
+        videos = search_videos(topic, page_num)
 
-        for data in videos:
-            if data.width < data.height:  # look for vertical orientation videos
-                if data.url not in video_pool:
-                    add_to_video_pool(data.url)
+        if not videos:
+            break
 
-                    download_video('https://www.pexels.com/video/' + str(data.id) +
-                                   '/download', 'video/' + data.url.split('/')[-2] + '.mp4')
+        for data in videos:
+            if data['width'] < data['height']:  # look for vertical orientation videos
+                if data['url'] not in video_pool and data['url'] not in spare and data not in candidates:
+                    candidates.append(data)
 
-                    return 'video/' + data.url.split('/')[-2] + '.mp4'
+                    if len(candidates) == count:
+                        break
 
         page_num += 1
 
+    if not candidates:
+        raise FileNotFoundError('There are no new vertical videos on Pexels for "' + topic + '"')
+
+    paths = ['video/' + data['url'].rstrip('/').split('/')[-1] + '.' + str(os.getpid()) + '.mp4'
+             for data in candidates]
+
+    # download the candidates in parallel
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        downloads = [executor.submit(download_video, PEXELS_DOWNLOAD_URL.format(id=data['id']), path)
+                     for data, path in zip(candidates, paths)]
+
+        try:
+            for download in downloads:
+                download.result()
+        except Exception:
+            # wait for the other downloads before removing what they saved
+            for download in downloads:
+                download.exception()
+
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+            raise
+
+    return [(data['url'], path) for data, path in zip(candidates, paths)]
+
+
+def fetch_video(topic):
+    """
+    Downloads a random vertical video from Pexels.
+
+    :param topic: Topic of the video
+    :return: Path of the downloaded video
+    """
+
+    while True:
+        for url, path in fetch_videos(topic, 1):
+            # another process may have claimed the video since the pool was read
+            if add_to_video_pool(url):
+                return path
+
+            os.remove(path)
+
+
+def proxy_filter(size: tuple, target: tuple = PROXY_SIZE, fps: int = PROXY_FPS):
+    """
+    Builds the ffmpeg filter which normalizes a video to the proxy format.
+
+    :param size: Size of the source video as (width, height)
+    :param target: Size of the proxy as (width, height)
+    :param fps: Frame rate of the proxy
+    :return: ffmpeg video filter string
+    """
+
+    width, height = size
+    target_width, target_height = target
+
+    if width * target_height == height * target_width:
+        # same aspect ratio, a plain scale is enough
+        scale = f'scale={target_width}:{target_height}'
+    else:
+        # fill the frame and center-crop instead of stretching
+        scale = (f'scale={target_width}:{target_height}:force_original_aspect_ratio=increase,'
+                 f'crop={target_width}:{target_height}')
+
+    return f'{scale},setsar=1,fps={fps}'
+
+
+def make_proxy(source: str, destination: str, size: tuple, start: float = None, duration: float = None):
+    """
+    Transcodes a video to the proxy format with a keyframe every second for fast seeking.
+
+    :param source: Path of the source video
+    :param destination: Path of the proxy video
+    :param size: Size of the source video as (width, height)
+    :param start: Optional start second of the section to transcode
+    :param duration: Optional duration of the section to transcode
+    :return: None
+    """
+
+    temp_path = destination + '.' + str(os.getpid()) + '.tmp.mp4'
+
+    command = ['ffmpeg', '-y', '-v', 'error']
+
+    if start is not None:
+        command += ['-ss', str(start)]
+
+    command += ['-i', source]
+
+    if duration is not None:
+        command += ['-t', str(duration)]
+
+    command += ['-an',
+                '-vf', proxy_filter(size),
+                '-c:v', 'libx264',
+                '-preset', 'medium',
+                '-crf', '18',
+                '-pix_fmt', 'yuv420p',
+                '-g', str(PROXY_FPS),
+                '-keyint_min', str(PROXY_FPS),
+                '-sc_threshold', '0',
+                '-movflags', '+faststart',
+                temp_path]
+
+    result = subprocess.run(command, capture_output=True, text=True)
+
+    if result.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise IOError(f'ffmpeg failed to create a proxy for "{source}": {result.stderr.strip()}')
+
+    os.replace(temp_path, destination)
+
+
+def ingest_proxies(source_dir: str = 'video_archive', proxy_dir: str = PROXY_ARCHIVE):
+    """
+    Creates proxies for every archive video which does not have an up-to-date proxy yet.
+
+    :param source_dir: Directory of the archive videos
+    :param proxy_dir: Directory of the proxy videos
+    :return: None
+    """
+
+    os.makedirs(proxy_dir, exist_ok=True)
+
+    for entry in get_media_index(source_dir, ('.mp4',)).get_entries():
+        destination = os.path.join(proxy_dir, os.path.basename(entry['path']))
+
+        if os.path.exists(destination) and os.path.getmtime(destination) >= entry['mtime']:
+            continue
+
+        try:
+            make_proxy(entry['path'], destination, (entry['width'], entry['height']))
+        except IOError as e:
+            print(f"Error creating proxy: {str(e)}")
+
+    get_media_index(proxy_dir, ('.mp4',)).refresh()
+
 
 def random_pexels_video_clip(duration: float, topic: str):
     """
@@ -196,71 +484,89 @@ def random_pexels_video_clip(duration: float, topic: str):
     :return: 8-second video clip
     """
 
-    while True:
-        # fetch a random video from Pexels
-        video_path = fetch_video(topic)
+    video_path = None
 
-        clip = VideoFileClip(video_path).without_audio()
+    while video_path is None:
+        # use the videos left over by the last short on this topic, or fetch several from Pexels at once
+        videos = spare_videos.pop(topic, None) or fetch_videos(topic, DOWNLOAD_WORKERS)
 
-        if clip.duration >= duration:
-            break
+        # keep the first one with a usable segment
+        for i, (url, path) in enumerate(videos):
+            info = probe(path)
+            start = None
+
+            if info['duration'] >= duration:
+                info['scenes'] = analyze_scenes(path)
+                start = pick_start(info, duration)
 
-    # resize the clip
-    clip = clip.resize(newsize=(1080, 1920))
+            # claim the chosen video, and unusable ones so they are not downloaded again, unless another
+            # process claimed it since the pool was read
+            if add_to_video_pool(url) and start is not None:
+                video_path = path
+
+                # videos after the chosen one stay unclaimed and on disk for the next short
+                spare_videos[topic] = videos[i + 1:]
+                break
 
-    # get a random 8-second segment based on clip duration
-    end_point = random.uniform(duration, clip.duration)
+            os.remove(path)
 
-    # get subclip
-    clip = clip.subclip(end_point - duration, end_point)
+    # transcode only the segment, already normalized to the proxy format
+    proxy_path = os.path.splitext(video_path)[0] + '.proxy.mp4'
+    make_proxy(video_path, proxy_path, (info['width'], info['height']), start=start, duration=duration)
 
-    # delete the downloaded video to prevent clutter
+    clip = VideoFileClip(proxy_path).set_duration(duration)
+
+    # delete the downloaded videos to prevent clutter
     os.remove(video_path)
+    os.remove(proxy_path)
 
     # return the final product
     return clip
 
 
-def random_video_clip(duration: float):
+def random_video_clip(duration: float, scratch: str = None):
     """
     Retrieves a random video clip from the 'video' directory with a specified duration.
 
     :param duration: Desired duration of the video clip
+    :param scratch: Directory for the extracted segment
     :return: Video clip with the specified duration
     """
 
     if duration > int(os.getenv('MAX_DURATION')):
         raise Exception('Given duration exceeds the maximum duration in the video library.')
 
-    checked_videos = []
+    segment_path = scratch_file(scratch, '.mp4')
+    proxies = get_media_index(PROXY_ARCHIVE, ('.mp4',))
 
-    # list all video files in the 'video' directory
-    video_files = [file for file in os.listdir('video_archive') if file.endswith('.mp4')]
+    if proxies.get_entries():
+        # proxies have a keyframe every second, so the whole-second starts of usable shots can be stream copied
+        entry, start = proxies.pick_segment(duration, choose=pick_start)
 
-    while True:
-        # randomly select a video path from the list of video files
-        video_path = random.choice(video_files)
+        extract_segment(entry['path'], segment_path, start, duration)
+    else:
+        # pick a usable segment from the archive index without opening any files, avoiding recent segments
+        entry, start = get_media_index('video_archive', ('.mp4',)).pick_segment(duration, choose=pick_start)
 
-        if video_path not in checked_videos:
-            checked_videos.append(video_path)
-            video_path = os.path.join('video_archive', video_path)
+        # cut and normalize only the segment
+        make_proxy(entry['path'], segment_path, (entry['width'], entry['height']), start=start, duration=duration)
 
-            clip = VideoFileClip(video_path).without_audio()
+    clip = VideoFileClip(segment_path).without_audio().set_duration(duration)
 
-            if clip.duration >= duration:
-                break
-        elif len(checked_videos) == len(video_files):
-            raise FileNotFoundError('There are no videos with a duration of at least ' + str(duration) + ' seconds')
+    # moviepy copies clips on every transformation, so only this exact object is known to show the file unchanged
+    PLAIN_CLIPS.add(clip)
+
+    return clip
 
-    # resize the clip
-    clip = clip.resize(newsize=(1080, 1920))
 
-    # get a random segment based on clip duration
-    end_point = random.uniform(duration, clip.duration)
+def is_plain_clip(clip: VideoClip):
+    """
+    Checks whether a clip shows its video file unchanged from the start, so the file can be read directly instead.
 
-    # get subclip
-    clip = clip.subclip(end_point - duration, end_point)
+    :param clip: Video clip
+    :return: True if the clip came from random_video_clip untransformed and its file still exists
+    """
 
-    return clip
+    return clip in PLAIN_CLIPS and os.path.exists(clip.filename)
 
 
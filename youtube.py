@@ -1,36 +1,388 @@
+import os
+import time
+import random
+import threading
+import functools
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from simple_youtube_api.Channel import Channel
 from simple_youtube_api.LocalVideo import LocalVideo
 
+# uploader settings, overridable through the environment
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', 5))
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
 
-def upload(file: str, title: str, description: str, tags: list, category: str, status: str, thumbnail=None):
-    # logon to the channel
-    channel = Channel()
-    channel.login("data_archive/client_secrets.json", "credentials.storage")
 
-    # set up the video that is going to be uploaded
-    video = LocalVideo(file_path=file)
+class ChannelTransport:
+    def __init__(self, secrets: str = "data_archive/client_secrets.json", storage: str = "credentials.storage"):
+        """
+        Constructor for the ChannelTransport class, which uploads through simple_youtube_api.
 
-    # create snippet
-    video.set_title(title)
-    video.set_description(description)
-    video.set_tags(tags)
-    video.set_category(category)
-    video.set_default_language("en-US")
+        :param secrets: path of the OAuth client secrets
+        :param storage: path of the stored credentials
+        :return: None
+        """
+        self._secrets = secrets
+        self._storage = storage
 
-    # set status
-    video.set_embeddable(True)
-    video.set_license("creativeCommon")
-    video.set_privacy_status(status)
-    video.set_public_stats_viewable(True)
+        # the underlying HTTP client is not thread-safe, so every upload thread has its own channel
+        self._local = threading.local()
 
-    # set thumbnail
-    # video.set_thumbnail_path(thumbnail)
+        # uploaded videos waiting to be liked, by video id
+        self._videos = {}
+        self._lock = threading.Lock()
 
-    # upload video and printing the results
-    video = channel.upload_video(video)
+    def get_channel(self):
+        """
+        Method to get the authenticated channel of the current thread, logging in only the first time
 
-    # like the video
-    video.like()
+        :return: Channel
+        """
+        channel = getattr(self._local, 'channel', None)
 
-    # return video id
-    return video.id
+        if channel is None:
+            channel = Channel()
+            channel.login(self._secrets, self._storage)
+            self._local.channel = channel
+
+        return channel
+
+    def upload(self, file: str, metadata: dict, progress: dict, checkpoint=None):
+        """
+        Method to upload a video
+
+        :param file: path of the video
+        :param metadata: title, description, tags, category and status of the video
+        :param progress: state kept between attempts of the same upload, unused as uploads cannot be resumed
+        :param checkpoint: unused as uploads cannot be resumed
+        :return: video id
+        """
+        # set up the video that is going to be uploaded
+        video = LocalVideo(file_path=file)
+
+        # create snippet
+        video.set_title(metadata['title'])
+        video.set_description(metadata['description'])
+        video.set_tags(metadata['tags'])
+        video.set_category(metadata['category'])
+        video.set_default_language("en-US")
+
+        # set status
+        video.set_embeddable(True)
+        video.set_license("creativeCommon")
+        video.set_privacy_status(metadata['status'])
+        video.set_public_stats_viewable(True)
+
+        # upload video
+        video = self.get_channel().upload_video(video)
+
+        with self._lock:
+            self._videos[video.id] = video
+
+        return video.id
+
+    def like(self, video_id: str):
+        """
+        Method to like an uploaded video
+
+        :param video_id: id of the video
+        :return: None
+        """
+        with self._lock:
+            video = self._videos.pop(video_id)
+
+        video.like()
+
+
+class ResumableTransport:
+    def __init__(self, token, base_url: str = 'https://www.googleapis.com', chunk_size: int = UPLOAD_CHUNK_SIZE):
+        """
+        Constructor for the ResumableTransport class, which speaks the YouTube resumable upload protocol directly.
+
+        :param token: OAuth access token, or a function returning a current one
+        :param base_url: API host, may point at a local fake endpoint
+        :param chunk_size: bytes sent per request, a multiple of 256 KiB
+        :return: None
+        """
+        self._token = token
+        self._base_url = base_url.rstrip('/')
+        self._chunk_size = chunk_size
+        self._session = requests.Session()
+
+    def headers(self):
+        """
+        Method to get the authorization headers
+
+        :return: dictionary of headers
+        """
+        token = self._token() if callable(self._token) else self._token
+
+        return {'Authorization': 'Bearer ' + token}
+
+    def start(self, file: str, metadata: dict):
+        """
+        Method to open an upload session
+
+        :param file: path of the video
+        :param metadata: title, description, tags, category and status of the video
+        :return: upload session url
+        """
+        body = {
+            'snippet': {
+                'title': metadata['title'],
+                'description': metadata['description'],
+                'tags': metadata['tags'],
+                'categoryId': metadata['category'],
+                'defaultLanguage': 'en-US'
+            },
+            'status': {
+                'privacyStatus': metadata['status'],
+                'embeddable': True,
+                'license': 'creativeCommon',
+                'publicStatsViewable': True
+            }
+        }
+
+        headers = self.headers()
+        headers['X-Upload-Content-Length'] = str(os.path.getsize(file))
+        headers['X-Upload-Content-Type'] = 'video/mp4'
+
+        r = self._session.post(self._base_url + '/upload/youtube/v3/videos',
+                               params={'uploadType': 'resumable', 'part': 'snippet,status'},
+                               json=body, headers=headers, timeout=60)
+        r.raise_for_status()
+
+        return r.headers['Location']
+
+    def offset(self, session_url: str, total: int):
+        """
+        Method to ask the server how many bytes of an upload it has received
+
+        :param session_url: upload session url
+        :param total: size of the video
+        :return: tuple of (next byte offset, video id if the upload is already complete)
+        """
+        headers = self.headers()
+        headers['Content-Range'] = f'bytes */{total}'
+
+        r = self._session.put(session_url, headers=headers, timeout=60)
+
+        return self.progress(r)
+
+    @staticmethod
+    def progress(r: requests.Response):
+        """
+        Method to read the progress of an upload from a response
+
+        :param r: response to an upload request
+        :return: tuple of (next byte offset, video id if the upload is complete)
+        """
+        if r.status_code in (200, 201):
+            return None, r.json()['id']
+
+        if r.status_code == 308:
+            received = r.headers.get('Range')
+            return (int(received.split('-')[1]) + 1 if received else 0), None
+
+        r.raise_for_status()
+        raise IOError(f'Unexpected upload response: {r.status_code}')
+
+    def upload(self, file: str, metadata: dict, progress: dict, checkpoint=None):
+        """
+        Method to upload a video in chunks, resuming from the last received byte after a failure
+
+        :param file: path of the video
+        :param metadata: title, description, tags, category and status of the video
+        :param progress: state kept between attempts of the same upload, holding the upload session url
+        :param checkpoint: optional function called with the progress once the session is started
+        :return: video id
+        """
+        total = os.path.getsize(file)
+        session_url = progress.get('session_url')
+        offset = 0
+        video_id = None
+        failures = 0
+
+        if session_url is not None:
+            # an earlier attempt failed, continue its session instead of sending the video again
+            try:
+                offset, video_id = self.offset(session_url, total)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in (404, 410):
+                    raise
+
+                # the session expired before any video was published
+                session_url = None
+
+        if session_url is None:
+            session_url = self.start(file, metadata)
+            progress['session_url'] = session_url
+
+            if checkpoint is not None:
+                checkpoint(progress)
+
+        with open(file, 'rb') as infile:
+            while video_id is None:
+                infile.seek(offset)
+                chunk = infile.read(self._chunk_size)
+
+                headers = self.headers()
+                headers['Content-Range'] = f'bytes {offset}-{offset + len(chunk) - 1}/{total}'
+
+                try:
+                    r = self._session.put(session_url, data=chunk, headers=headers, timeout=300)
+
+                    if r.status_code >= 500:
+                        raise IOError(f'Upload server error: {r.status_code}')
+
+                    offset, video_id = self.progress(r)
+                    failures = 0
+                except (requests.ConnectionError, requests.Timeout, IOError):
+                    failures += 1
+
+                    if failures > 3:
+                        raise
+
+                    # ask where to continue, a failure here is left to the uploader's retries
+                    offset, video_id = self.offset(session_url, total)
+
+        return video_id
+
+    def like(self, video_id: str):
+        """
+        Method to like an uploaded video
+
+        :param video_id: id of the video
+        :return: None
+        """
+        r = self._session.post(self._base_url + '/youtube/v3/videos/rate', params={'id': video_id, 'rating': 'like'},
+                               headers=self.headers(), timeout=60)
+        r.raise_for_status()
+
+
+class Uploader:
+    def __init__(self, transport=None, workers: int = UPLOAD_WORKERS, retries: int = UPLOAD_RETRIES,
+                 backoff: float = 2.0):
+        """
+        Constructor for the Uploader class.
+
+        :param transport: object with an upload(file, metadata, progress, checkpoint) method returning the video
+                          id, and a like(video_id) method
+        :param workers: number of concurrent uploads
+        :param retries: number of times a failed upload is retried
+        :param backoff: base of the exponential delay between retries, in seconds
+        :return: None
+        """
+        self._transport = transport if transport is not None else ChannelTransport()
+        self._retries = retries
+        self._backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def run(self, file: str, metadata: dict, progress: dict = None, checkpoint=None):
+        """
+        Method run by the workers, uploading a video with retries and liking it once it is published
+
+        :param file: path of the video
+        :param metadata: title, description, tags, category and status of the video
+        :param progress: state of an earlier run of the same upload, to be resumed
+        :param checkpoint: optional function called with the progress whenever it should be persisted
+        :return: video id
+        """
+        # lets a retry resume the upload of the failed attempt
+        progress = progress if progress is not None else {}
+
+        # an earlier run published the video already
+        if progress.get('video_id') is not None:
+            return progress['video_id']
+
+        for attempt in range(self._retries + 1):
+            try:
+                video_id = self._transport.upload(file, metadata, progress, checkpoint)
+                break
+            except Exception as e:
+                if attempt == self._retries:
+                    raise
+
+                # exponential backoff with jitter
+                delay = self._backoff ** attempt + random.uniform(0, 1)
+                print(f"Upload of {file} failed, retrying in {delay:.1f}s: {str(e)}")
+                time.sleep(delay)
+
+        progress['video_id'] = video_id
+
+        if checkpoint is not None:
+            checkpoint(progress)
+
+        # the video is published, so a failed like must not upload it again
+        try:
+            self._transport.like(video_id)
+        except Exception as e:
+            print(f"Could not like video {video_id}: {str(e)}")
+
+        return video_id
+
+    def submit(self, file: str, title: str, description: str, tags: list, category: str, status: str,
+               progress: dict = None, checkpoint=None):
+        """
+        Method to queue a video for upload
+
+        :param file: path of the video
+        :param title: title of the video
+        :param description: description of the video
+        :param tags: tags of the video
+        :param category: category id of the video
+        :param status: privacy status of the video
+        :param progress: state of an earlier run of the same upload, to be resumed
+        :param checkpoint: optional function called with the progress whenever it should be persisted
+        :return: Future resolving to the video id
+        """
+        metadata = {'title': title, 'description': description, 'tags': tags, 'category': category,
+                    'status': status}
+
+        return self._executor.submit(self.run, file, metadata, progress, checkpoint)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Method to stop the workers
+
+        :param wait: wait for queued uploads to finish
+        :return: None
+        """
+        self._executor.shutdown(wait=wait)
+
+
+@functools.lru_cache(maxsize=None)
+def get_uploader():
+    """
+    Gets the shared uploader, which logs in to the channel once.
+
+    :return: Uploader
+    """
+
+    return Uploader()
+
+
+def upload_async(file: str, title: str, description: str, tags: list, category: str, status: str,
+                 progress: dict = None, checkpoint=None):
+    """
+    Queues a video for upload without blocking.
+
+    :param file: Path of the video
+    :param title: Title of the video
+    :param description: Description of the video
+    :param tags: Tags of the video
+    :param category: Category id of the video
+    :param status: Privacy status of the video
+    :param progress: State of an earlier run of the same upload, to be resumed
+    :param checkpoint: Optional function called with the progress whenever it should be persisted
+    :return: Future resolving to the video id
+    """
+
+    return get_uploader().submit(file, title, description, tags, category, status, progress, checkpoint)
+
+
+def upload(file: str, title: str, description: str, tags: list, category: str, status: str, thumbnail=None,
+           progress: dict = None, checkpoint=None):
+    # upload through the shared uploader and wait for the video id
+    return upload_async(file, title, description, tags, category, status, progress, checkpoint).result()